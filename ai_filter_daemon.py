@@ -2,58 +2,255 @@
 Daemon handling SpamDetector instance and reload on SIGHUB
 """
 
+import hashlib
+import os
 import signal
 import threading
+import time
+from email import policy
 from email.message import EmailMessage
+from email.parser import BytesParser
 from types import FrameType
+from typing import Callable
 
-from config_model import SpamDetectorModel
-from mail_logging import LOG_INFO
+import config
+from constants import (RESULT_CACHE_SIZE_DEFAULT, RESULT_CACHE_TTL_DEFAULT,
+                       SPAM_THRESHOLD_DEFAULT)
+from mail_logging import LOG_DEBUG, LOG_ERROR, LOG_INFO
 from mail_logging.logging import log
+from mail_types import ClassificationResult
 from models.base import SpamDetectorModelBase
-from tools import read_mail
+from result_cache import ResultCache, get_content_key
+from tools import convert_message, read_mail
+
+# settings missing in configurations written before they were added
+RESULT_CACHE_SIZE: int = getattr(config, 'RESULT_CACHE_SIZE', RESULT_CACHE_SIZE_DEFAULT)
+RESULT_CACHE_TTL: float = getattr(config, 'RESULT_CACHE_TTL', RESULT_CACHE_TTL_DEFAULT)
+SPAM_THRESHOLD: float = getattr(config, 'SPAM_THRESHOLD', SPAM_THRESHOLD_DEFAULT)
 
 
 class AIFilterDaemon:
     """
     Threadsafe class providing SpamDetector instance and reloading on SIGHUB
+
+    A reload loads a new model in a background thread and replaces the
+    current one when it is ready. Mails being classified meanwhile finish on
+    the old model.
     """
 
     def __init__(self) -> None:
         self._spam_detector_model: SpamDetectorModelBase | None = None
         self._lock = threading.RLock()
+        self._reload_callbacks: list[Callable[[], None]] = []
+        self._reload_thread: threading.Thread | None = None
+        self._reload_pending = False
+        # predictions of recently seen mail contents
+        self._result_cache: ResultCache[float] = ResultCache(
+            RESULT_CACHE_SIZE, RESULT_CACHE_TTL
+        )
         self._original_hup_handler = signal.getsignal(signal.SIGHUP)
 
         def handle_sighup(_signum: int, _frame: FrameType | None):
-            if self._spam_detector_model is None:
-                log(LOG_INFO, "Not yet initialized. Do nothing.")
-                return
-
-            log(LOG_INFO, "Reloading model...")
-            with self._lock:
-                self._spam_detector_model.reload()
-            log(LOG_INFO, "Done reloading model.")
+            self.reload()
 
         signal.signal(signal.SIGHUP, handler=handle_sighup)
 
     def __del__(self):
         signal.signal(signal.SIGHUP, handler=self._original_hup_handler)
 
+    def after_fork(self) -> None:
+        """
+        Reset reload state and callbacks inherited by a forked process
+
+        The threads of the parent do not exist in the child.
+        """
+        self._lock = threading.RLock()
+        self._reload_thread = None
+        self._reload_pending = False
+        self._reload_callbacks = []
+
+    def add_reload_callback(self, callback: Callable[[], None]) -> None:
+        """
+        Register a callback to be called after the model has been reloaded
+        """
+        self._reload_callbacks.append(callback)
+
+    def reload(self) -> None:
+        """
+        Reload the model in the background
+
+        A reload requested while another one is running is done after it.
+        """
+        with self._lock:
+            if self._reload_thread is not None:
+                self._reload_pending = True
+                return
+            self._reload_thread = threading.Thread(
+                target=self._reload, name='model-reload', daemon=True
+            )
+            self._reload_thread.start()
+
+    def _reload(self) -> None:
+        while True:
+            with self._lock:
+                self._reload_pending = False
+
+            if self._spam_detector_model is None:
+                log(LOG_INFO, "Model not yet loaded. Nothing to reload.")
+            else:
+                log(LOG_INFO, "Reloading model...")
+                try:
+                    spam_detector_model = self._create_spam_detector()
+                    spam_detector_model.load_model()
+                except Exception as e:  # pylint: disable=broad-exception-caught,invalid-name
+                    log(LOG_ERROR, f"Reloading model failed. Keeping the current one: {e}")
+                else:
+                    # Replacing the reference is atomic
+                    self._spam_detector_model = spam_detector_model
+                    self._result_cache.clear()
+                    log(LOG_INFO, "Done reloading model.")
+
+            for callback in self._reload_callbacks:
+                callback()
+
+            with self._lock:
+                if not self._reload_pending:
+                    self._reload_thread = None
+                    return
+
+    def watch(self, interval: float) -> None:
+        """
+        Reload the model when its files change
+
+        Args:
+            interval (float): seconds between checks of the model files
+        """
+        log(LOG_INFO, f"Checking model files for changes every {interval} seconds")
+        threading.Thread(
+            target=self._watch, args=(interval,), name='model-watch', daemon=True
+        ).start()
+
+    def _watch(self, interval: float) -> None:
+        fingerprint = self._get_model_fingerprint()
+        checksum = self._get_model_checksum()
+        while True:
+            time.sleep(interval)
+            new_fingerprint = self._get_model_fingerprint()
+            if new_fingerprint == fingerprint:
+                continue
+
+            # Wait for the training to finish writing the files
+            fingerprint = new_fingerprint
+            time.sleep(interval)
+            new_fingerprint = self._get_model_fingerprint()
+            if new_fingerprint != fingerprint:
+                continue
+
+            new_checksum = self._get_model_checksum()
+            if new_checksum == checksum:
+                log(LOG_DEBUG, "Model files touched but not changed")
+                continue
+
+            log(LOG_INFO, "Model files changed")
+            checksum = new_checksum
+            self.reload()
+
+    @staticmethod
+    def _get_model_fingerprint() -> list[tuple[str, int, int]]:
+        fingerprint: list[tuple[str, int, int]] = []
+        for file_name in AIFilterDaemon._create_spam_detector().get_model_files():
+            try:
+                stat = os.stat(file_name)
+            except OSError:
+                continue
+            fingerprint.append((file_name, stat.st_size, stat.st_mtime_ns))
+        return fingerprint
+
+    @staticmethod
+    def _get_model_checksum() -> str:
+        checksum = hashlib.sha256()
+        for file_name in AIFilterDaemon._create_spam_detector().get_model_files():
+            try:
+                with open(file_name, 'rb') as file_handle:
+                    # generations have different paths for the same files
+                    checksum.update(
+                        os.path.basename(file_name).encode('utf-8', errors='surrogateescape')
+                    )
+                    checksum.update(hashlib.file_digest(file_handle, 'sha256').digest())
+            except OSError:
+                continue
+        return checksum.hexdigest()
+
+    def preload(self) -> None:
+        """
+        Load the model now instead of on the first mail
+        """
+        self._get_spam_detector().load_model()
+
+    def warm_up(self) -> None:
+        """
+        Load the model if not done yet and classify a sample mail, so the
+        first mail does not wait for imports, loading and caches
+        """
+        message = EmailMessage()
+        message['From'] = 'warm-up@localhost'
+        message['Subject'] = 'Warm up'
+        message.set_content('Warming up the spam detector')
+        self._get_spam_detector().predict_mail(read_mail(message))
+
+    @staticmethod
+    def _create_spam_detector() -> SpamDetectorModelBase:
+        # importing the models imports sklearn, which takes most of the startup time
+        from config_model import SpamDetectorModel  # pylint: disable=import-outside-toplevel
+        return SpamDetectorModel()
+
     def _get_spam_detector(self):
         with self._lock:
             if self._spam_detector_model is not None:
                 return self._spam_detector_model
 
-            self._spam_detector_model = SpamDetectorModel()
+            self._spam_detector_model = self._create_spam_detector()
             return self._spam_detector_model
 
-    def predict_mail(self, mail_body: EmailMessage) -> tuple[bool, str]:
-        prediction = self._get_spam_detector().predict_mail(
-            content=read_mail(message=mail_body)
-        )
+    def predict_mail(self, mail_body: EmailMessage, timings: dict[str, float] | None = None) -> ClassificationResult:
+        timings = {} if timings is None else timings
+        spam_detector = self._get_spam_detector()
+        start = time.perf_counter()
+        content = read_mail(message=mail_body)
+        timings['extract'] = time.perf_counter() - start
 
-        result = "SPAM" if prediction else "HAM"
+        key = get_content_key(content, spam_detector.generation)
+        score = self._result_cache.get(key)
+        cached = score is not None
+        if score is None:
+            score = spam_detector.predict_mail(content=content, timings=timings)
+            # the model and its generation are loaded with the first mail
+            self._result_cache.put(get_content_key(content, spam_detector.generation), score)
+        else:
+            log(
+                LOG_DEBUG,
+                "Using cached classification (%d hits, %d misses)",
+                self._result_cache.hits, self._result_cache.misses
+            )
 
-        log(LOG_INFO, f"Parsing finished with classification {result}")
+        is_spam = score >= SPAM_THRESHOLD
+        result = "SPAM" if is_spam else "HAM"
 
-        return (prediction, result)
+        log(LOG_INFO, "Parsing finished with classification %s (score %.3f)", result, score)
+
+        return ClassificationResult(
+            is_spam=is_spam,
+            label=result,
+            score=score,
+            stages=tuple(timings.items()),
+            cached=cached,
+            generation=spam_detector.generation,
+        )
+
+    def predict_mail_bytes(self, mail_data: bytes) -> ClassificationResult:
+        parser = BytesParser(policy=policy.default)
+        start = time.perf_counter()
+        message = convert_message(parser.parsebytes(mail_data))
+        return self.predict_mail(
+            message, timings={'parse': time.perf_counter() - start}
+        )
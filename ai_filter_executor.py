@@ -0,0 +1,210 @@
+"""
+Executor running the mail classification off the SMTP event loop
+"""
+
+import asyncio
+import multiprocessing
+import signal
+import time
+from concurrent.futures import (BrokenExecutor, Executor,
+                                ProcessPoolExecutor, ThreadPoolExecutor, wait)
+from sqlite3 import OperationalError
+
+import metrics
+from ai_filter_daemon import AIFilterDaemon
+from constants import CLASSIFIER_EXECUTOR_PROCESS, CLASSIFIER_EXECUTOR_THREAD
+from mail_logging import LOG_ERROR, LOG_INFO, LOG_WARN, LogPriorityType
+from mail_logging.logging import init_logger, log
+from mail_types import ClassificationResult
+
+_worker_filter_daemon: AIFilterDaemon | None = None
+
+
+def _init_worker(log_file: str, log_level: LogPriorityType) -> None:
+    """
+    Initialize a classification process and load the model
+    """
+    global _worker_filter_daemon  # pylint: disable=global-statement
+    init_logger(log_file, log_level)
+
+    _worker_filter_daemon = AIFilterDaemon()
+    # reloading is done by replacing the pool in the main process
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    _worker_filter_daemon.preload()
+
+
+def _warm_up_worker() -> None:
+    assert _worker_filter_daemon is not None
+    _worker_filter_daemon.warm_up()
+
+
+def _predict_mail_in_worker(mail_data: bytes) -> ClassificationResult:
+    assert _worker_filter_daemon is not None
+    return _worker_filter_daemon.predict_mail_bytes(mail_data)
+
+
+class AIFilterExecutor:
+    """
+    Classifies mails in a thread or process pool and limits the number of
+    mails in flight
+    """
+
+    def __init__(
+        self,
+        filter_daemon: AIFilterDaemon,
+        executor_type: str,
+        workers: int,
+        max_in_flight: int,
+        log_file: str,
+        log_level: LogPriorityType,
+    ) -> None:
+        if executor_type not in (CLASSIFIER_EXECUTOR_THREAD, CLASSIFIER_EXECUTOR_PROCESS):
+            raise ValueError(f"Unknown classifier executor '{executor_type}'")
+
+        self.filter_daemon = filter_daemon
+        self.executor_type = executor_type
+        self.workers = workers
+        self.max_in_flight = max_in_flight
+        self.log_file = log_file
+        self.log_level = log_level
+        self.in_flight = 0
+        self._executor: Executor = self._create_executor()
+        # loop submitting the mails, the pool is only replaced in it
+        self._loop: asyncio.AbstractEventLoop | None = None
+        metrics.CLASSIFIER_IN_FLIGHT.set_function(lambda: self.in_flight)
+
+        if self.executor_type == CLASSIFIER_EXECUTOR_PROCESS:
+            filter_daemon.add_reload_callback(self._replace_executor)
+
+    def _create_executor(self) -> Executor:
+        log(
+            LOG_INFO,
+            f"Classifying mails in {self.workers} {self.executor_type} workers"
+        )
+        if self.executor_type == CLASSIFIER_EXECUTOR_THREAD:
+            return ThreadPoolExecutor(
+                max_workers=self.workers,
+                thread_name_prefix='classifier'
+            )
+
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            # do not fork the threads of the running smtp server
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(self.log_file, self.log_level),
+        )
+
+    def _replace_executor(self) -> None:
+        """
+        Start new workers loading the new model and let the old ones finish
+        the mails they are working on
+
+        Runs in the reload thread. The new pool is warmed up before it gets
+        any mail and swapped in on the event loop, so no mail is submitted to
+        the old pool after it has been shut down.
+        """
+        start = time.perf_counter()
+        new_executor = self._create_executor()
+        # the pool starts a process for each task while none is idle
+        futures = [new_executor.submit(_warm_up_worker) for _ in range(self.workers)]
+        wait(futures)
+        for future in futures:
+            if error := future.exception():
+                log(LOG_WARN, "Warming up the new workers failed, keeping the current ones: %s", error)
+                new_executor.shutdown(wait=False, cancel_futures=True)
+                return
+        log(LOG_INFO, "New workers warmed up in %.2f seconds", time.perf_counter() - start)
+
+        def swap_executor() -> None:
+            old_executor = self._executor
+            self._executor = new_executor
+            old_executor.shutdown(wait=False)
+
+        if self._loop is None:
+            # no mail submitted yet
+            swap_executor()
+            return
+        try:
+            self._loop.call_soon_threadsafe(swap_executor)
+        except RuntimeError:
+            # the loop is closed, the daemon is stopping
+            new_executor.shutdown(wait=False, cancel_futures=True)
+
+    def _replace_broken_executor(self, executor: Executor) -> None:
+        """
+        Replace a pool whose worker died, e.g. killed by the OOM killer
+
+        Runs on the event loop, so no mail is submitted to the broken pool
+        afterwards. Mails failing with the same pool do not replace it again.
+        """
+        if self._executor is not executor:
+            return
+        log(LOG_ERROR, "A classifier worker died. Starting new workers.")
+        self._executor = self._create_executor()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def try_acquire(self) -> bool:
+        """
+        Reserve a slot for a mail to classify
+
+        Must be called from the event loop. Returns False if the queue is full.
+        """
+        if self.in_flight >= self.max_in_flight:
+            return False
+        self.in_flight += 1
+        return True
+
+    def release(self) -> None:
+        self.in_flight -= 1
+
+    async def warm_up(self) -> None:
+        """
+        Load the model in the workers and classify a sample mail
+        """
+        loop = self._loop = asyncio.get_running_loop()
+        if self.executor_type == CLASSIFIER_EXECUTOR_THREAD:
+            await loop.run_in_executor(self._executor, self.filter_daemon.warm_up)
+            return
+
+        # the pool starts a process for each task while none is idle
+        await asyncio.gather(*(
+            loop.run_in_executor(self._executor, _warm_up_worker)
+            for _ in range(self.workers)
+        ))
+
+    async def predict_mail(self, mail_data: bytes) -> ClassificationResult:
+        """
+        Classify a mail in the pool
+
+        Raises:
+            OperationalError: if the model could not be loaded or a worker
+                died. The pool is replaced by a new one for the next mails.
+        """
+        loop = self._loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        executor = self._executor
+        try:
+            if self.executor_type == CLASSIFIER_EXECUTOR_THREAD:
+                result = await loop.run_in_executor(
+                    executor, self.filter_daemon.predict_mail_bytes, mail_data
+                )
+            else:
+                result = await loop.run_in_executor(
+                    executor, _predict_mail_in_worker, mail_data
+                )
+        except BrokenExecutor as error:
+            self._replace_broken_executor(executor)
+            raise OperationalError(f"Classifier workers are not usable: {error}") from error
+
+        # including the time waiting for a worker
+        metrics.STAGE_SECONDS.observe(time.perf_counter() - start, 'classify')
+        for stage, seconds in result.stages:
+            metrics.STAGE_SECONDS.observe(seconds, stage)
+        metrics.RESULT_CACHE.inc('hit' if result.cached else 'miss')
+        if result.generation is not None:
+            metrics.MODEL_GENERATION.set_info(result.generation)
+        return result
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True, cancel_futures=True)
@@ -6,17 +6,43 @@ import grp
 import os
 import pwd
 import re
+import signal
+import socket
+import sys
+import time
+from sqlite3 import OperationalError
+from types import FrameType
 
 from aiosmtpd.controller import Controller, UnixSocketController
+from aiosmtpd.smtp import SMTP
 
+import config
 from ai_filter_daemon import AIFilterDaemon
+from ai_filter_executor import AIFilterExecutor
 from config import (LISTENING_SOCKET_DATA, LOG_FILE, LOG_LEVEL,
                     NEXT_PEER_SOCKET_DATA)
-from constants import SERVER_PORT_DEFAULT
-from mail_logging import LOG_ERROR, LOG_INFO
-from mail_logging.logging import init_logger, log
+from constants import (CLASSIFIER_EXECUTOR_DEFAULT,
+                       CLASSIFIER_MAX_IN_FLIGHT_DEFAULT,
+                       CLASSIFIER_WORKERS_DEFAULT, METRICS_SOCKET_DATA_DEFAULT,
+                       MODEL_PRELOAD_BACKGROUND, MODEL_PRELOAD_BEFORE,
+                       MODEL_PRELOAD_DEFAULT, MODEL_PRELOAD_LAZY,
+                       MODEL_WATCH_INTERVAL_DEFAULT, SERVER_PORT_DEFAULT,
+                       SERVER_WORKERS_DEFAULT, WORKER_RESTART_DELAY)
+from mail_logging import LOG_ERROR, LOG_INFO, LOG_WARN
+from mail_logging.logging import init_logger, log, shutdown_logger
+from metrics import get_worker_socket_data, start_metrics_server
+from sd_notify import notify
 from smtp_tools import AISpamFrowarding
 
+# settings missing in configurations written before they were added
+CLASSIFIER_EXECUTOR: str = getattr(config, 'CLASSIFIER_EXECUTOR', CLASSIFIER_EXECUTOR_DEFAULT)
+CLASSIFIER_MAX_IN_FLIGHT: int = getattr(config, 'CLASSIFIER_MAX_IN_FLIGHT', CLASSIFIER_MAX_IN_FLIGHT_DEFAULT)
+CLASSIFIER_WORKERS: int = getattr(config, 'CLASSIFIER_WORKERS', CLASSIFIER_WORKERS_DEFAULT)
+METRICS_SOCKET_DATA: str | None = getattr(config, 'METRICS_SOCKET_DATA', METRICS_SOCKET_DATA_DEFAULT)
+MODEL_PRELOAD: str = getattr(config, 'MODEL_PRELOAD', MODEL_PRELOAD_DEFAULT)
+MODEL_WATCH_INTERVAL: float = getattr(config, 'MODEL_WATCH_INTERVAL', MODEL_WATCH_INTERVAL_DEFAULT)
+SERVER_WORKERS: int = getattr(config, 'SERVER_WORKERS', SERVER_WORKERS_DEFAULT)
+
 
 class AIFilterMailDaemon:
     def __init__(
@@ -25,15 +51,28 @@ class AIFilterMailDaemon:
         next_peer: str,
         uid: int,
         gid: int,
+        workers: int = 1,
+        preload: str = MODEL_PRELOAD,
     ) -> None:
         init_logger(LOG_FILE, LOG_LEVEL)
+        if preload not in (MODEL_PRELOAD_BEFORE, MODEL_PRELOAD_BACKGROUND, MODEL_PRELOAD_LAZY):
+            raise ValueError(f"Unknown model preload mode '{preload}'")
 
         self.filter_daemon = AIFilterDaemon()
+        if MODEL_WATCH_INTERVAL > 0:
+            self.filter_daemon.watch(MODEL_WATCH_INTERVAL)
+        # created in the process serving the mails
+        self.classifier: AIFilterExecutor | None = None
         self.listen_socket = listen_socket
         self.next_peer = next_peer
         self.runas_uid = uid
         self.runas_gid = gid
+        self.workers = workers
+        self.preload = preload
         self.is_unix_socket = self.listen_socket.find('/') >= 0
+        # index of each worker process, a restarted worker gets the same index
+        self._worker_pids: dict[int, int] = {}
+        self._stopping = False
 
     def drop_privileges(self):
         if os.getuid() != 0:
@@ -47,7 +86,7 @@ class AIFilterMailDaemon:
         os.setuid(self.runas_uid)
         os.setgid(self.runas_gid)
 
-    def _get_unix_controller(self, handler: AISpamFrowarding):
+    def _prepare_unix_socket(self):
         if os.path.exists(self.listen_socket):
             log(
                 LOG_ERROR,
@@ -71,9 +110,12 @@ class AIFilterMailDaemon:
             LOG_INFO,
             f'Starting smtp server listening on socket {self.listen_socket}'
         )
+
+    def _get_unix_controller(self, handler: AISpamFrowarding):
+        self._prepare_unix_socket()
         return UnixSocketController(handler=handler, unix_socket=os.path.abspath(self.listen_socket))
 
-    def _get_ip_controller(self, handler: AISpamFrowarding):
+    def _get_address(self) -> tuple[str, int]:
         socket_data = self.listen_socket.split(sep=':', maxsplit=1)
         hostname: str = socket_data[0]
         port: int = (
@@ -88,23 +130,62 @@ class AIFilterMailDaemon:
             LOG_INFO,
             f'Starting smtp server listening on {hostname}:{port}'
         )
+        return (hostname, port)
+
+    def _get_ip_controller(self, handler: AISpamFrowarding):
+        hostname, port = self._get_address()
         return Controller(handler=handler, hostname=hostname, port=port)
 
-    def get_controller(self):
-        handler = AISpamFrowarding(
-            filter_daemon=self.filter_daemon,
+    def get_handler(self) -> AISpamFrowarding:
+        if self.classifier is None:
+            self.classifier = AIFilterExecutor(
+                filter_daemon=self.filter_daemon,
+                executor_type=CLASSIFIER_EXECUTOR,
+                workers=CLASSIFIER_WORKERS,
+                max_in_flight=CLASSIFIER_MAX_IN_FLIGHT,
+                log_file=LOG_FILE,
+                log_level=LOG_LEVEL,
+            )
+        return AISpamFrowarding(
+            classifier=self.classifier,
             next_peer=self.next_peer
         )
+
+    def get_controller(self):
+        handler = self.get_handler()
         if self.is_unix_socket:
             return self._get_unix_controller(handler)
 
         return self._get_ip_controller(handler)
 
+    async def _warm_up(self) -> None:
+        assert self.classifier is not None
+        log(LOG_INFO, "Warming up the model")
+        notify('STATUS=Loading model')
+        start = time.perf_counter()
+        try:
+            await self.classifier.warm_up()
+        except Exception as e:  # pylint:disable=broad-exception-caught,invalid-name
+            log(LOG_WARN, "Warming up the model failed, loading it with the first mail: %s", e)
+            return
+        log(LOG_INFO, "Model warmed up in %.2f seconds", time.perf_counter() - start)
+
     def run(self):
+        if self.workers > 1:
+            self.run_workers()
+            return
 
         async def start_server(loop: asyncio.AbstractEventLoop) -> None:  # pylint:disable=unused-argument,redefined-outer-name
+            # privileges are dropped before loading the model
             controller = self.get_controller()
+            if self.preload == MODEL_PRELOAD_BEFORE:
+                await self._warm_up()
             controller.start()
+            if METRICS_SOCKET_DATA:
+                await start_metrics_server(METRICS_SOCKET_DATA)
+            if self.preload == MODEL_PRELOAD_BACKGROUND:
+                await self._warm_up()
+            notify('READY=1', 'STATUS=Accepting mails')
 
         loop: asyncio.AbstractEventLoop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop=loop)
@@ -113,12 +194,152 @@ class AIFilterMailDaemon:
         try:
             loop.run_forever()
         except KeyboardInterrupt:
+            notify('STOPPING=1')
             log(
                 LOG_INFO,
                 "User abort indicated"
             )
             if self.is_unix_socket and os.path.exists(self.listen_socket):
                 os.remove(self.listen_socket)
+        finally:
+            if self.classifier is not None:
+                self.classifier.shutdown()
+
+    def _create_socket(self) -> socket.socket:
+        """
+        Create the listening socket shared by the workers
+        """
+        if self.is_unix_socket:
+            self._prepare_unix_socket()
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(os.path.abspath(self.listen_socket))
+            sock.listen(socket.SOMAXCONN)
+        else:
+            sock = socket.create_server(
+                self._get_address(), backlog=socket.SOMAXCONN
+            )
+        sock.setblocking(False)
+        return sock
+
+    def run_workers(self):
+        """
+        Serve mails in forked worker processes sharing the listening socket
+
+        The model is loaded before forking regardless of the preload mode, so
+        the workers start with it.
+        Workers exiting unexpectedly are restarted and SIGHUP is forwarded to
+        the workers after the model has been reloaded.
+        """
+        sock = self._create_socket()
+
+        notify('STATUS=Loading model')
+        try:
+            self.filter_daemon.warm_up()
+        except OperationalError as e:  # pylint:disable=invalid-name
+            log(LOG_WARN, f"Could not load model before starting workers: {e}")
+        self.filter_daemon.add_reload_callback(self._forward_reload)
+
+        def handle_stop(_signum: int, _frame: FrameType | None):
+            notify('STOPPING=1')
+            self._stopping = True
+            for pid in list(self._worker_pids):
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+        signal.signal(signal.SIGTERM, handle_stop)
+        signal.signal(signal.SIGINT, handle_stop)
+
+        log(LOG_INFO, f"Starting {self.workers} workers")
+        for index in range(self.workers):
+            self._start_worker(sock, index)
+        notify('READY=1', f'STATUS=Accepting mails in {self.workers} workers')
+
+        while self._worker_pids:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            if pid not in self._worker_pids:
+                continue
+            index = self._worker_pids.pop(pid)
+            if self._stopping:
+                continue
+
+            log(
+                LOG_ERROR,
+                f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}. Restarting it."
+            )
+            time.sleep(WORKER_RESTART_DELAY)
+            if not self._stopping:
+                self._start_worker(sock, index)
+
+        log(LOG_INFO, "All workers stopped")
+        sock.close()
+        if self.is_unix_socket and os.path.exists(self.listen_socket):
+            os.remove(self.listen_socket)
+
+    def _forward_reload(self) -> None:
+        for pid in list(self._worker_pids):
+            try:
+                os.kill(pid, signal.SIGHUP)
+            except ProcessLookupError:
+                pass
+
+    def _start_worker(self, sock: socket.socket, index: int) -> None:
+        # do not print buffered output twice
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid != 0:
+            self._worker_pids[pid] = index
+            return
+
+        exit_code = 1
+        try:
+            self._run_worker(sock, index)
+            exit_code = 0
+        except Exception as e:  # pylint:disable=broad-exception-caught,invalid-name
+            log(LOG_ERROR, f"Worker failed: {e}")
+        finally:
+            # exiting skips the atexit handlers
+            shutdown_logger()
+            sys.stdout.flush()
+            os._exit(exit_code)  # pylint:disable=protected-access
+
+    def _run_worker(self, sock: socket.socket, index: int) -> None:
+        # the supervisor stops the workers
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        self._worker_pids = {}
+        self.filter_daemon.after_fork()
+
+        loop: asyncio.AbstractEventLoop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop=loop)
+        handler = self.get_handler()
+
+        async def serve() -> None:
+            if self.is_unix_socket:
+                server = await loop.create_unix_server(lambda: SMTP(handler), sock=sock)
+            else:
+                server = await loop.create_server(lambda: SMTP(handler), sock=sock)
+            log(LOG_INFO, f"Worker {index} started")
+            if METRICS_SOCKET_DATA:
+                # every worker has its own metrics
+                await start_metrics_server(get_worker_socket_data(METRICS_SOCKET_DATA, index))
+            async with server:
+                await server.serve_forever()
+
+        task = loop.create_task(serve())
+        loop.add_signal_handler(signal.SIGTERM, task.cancel)
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            log(LOG_INFO, "Worker stopped")
+        finally:
+            assert self.classifier is not None
+            self.classifier.shutdown()
 
 
 def parse_args_and_start():
@@ -152,6 +373,19 @@ def parse_args_and_start():
         dest='group',
         help='The group to run this process as.',
     )
+    parser.add_argument(
+        '-w', '--workers',
+        dest='workers', type=int,
+        default=SERVER_WORKERS,
+        help='Number of processes serving mails on the shared socket.',
+    )
+    parser.add_argument(
+        '--preload',
+        dest='preload',
+        choices=(MODEL_PRELOAD_BEFORE, MODEL_PRELOAD_BACKGROUND, MODEL_PRELOAD_LAZY),
+        default=MODEL_PRELOAD,
+        help='Load the model before accepting connections, in the background or with the first mail.',
+    )
 
     args = parser.parse_args()
 
@@ -180,6 +414,8 @@ def parse_args_and_start():
         next_peer=next_peer,
         uid=runas_uid,
         gid=runas_gid,
+        workers=max(args.workers, 1),
+        preload=args.preload,
     ).run()
 
     if pid_file_name is not None and os.path.isfile(pid_file_name):
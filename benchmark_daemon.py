@@ -0,0 +1,341 @@
+"""
+Measure throughput and latency of the mail daemon by sending a corpus of
+mails through it with concurrent SMTP clients into an in-process sink
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import smtplib
+import socket
+import statistics
+import threading
+import time
+from email import policy
+from email.parser import BytesParser
+from typing import Callable
+
+from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import SMTP, Envelope, Session
+
+from ai_filter_mail_daemon import AIFilterMailDaemon
+from config_model import SpamDetectorModel
+from models.bayes_base import SpamDetectorModelBayesBase
+from next_hop import NextHopPool
+from result_cache import ResultCache
+from smtp_tools import splice_header_fields
+from tools import convert_message, read_mail, valid_file_name
+
+_WORDS = (
+    "offer free prize money click account meeting report project invoice"
+    " please review attached schedule discount winner urgent password team"
+    " order delivery update weekend lunch thanks regards newsletter"
+).split()
+
+
+def _get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def _get_rss() -> dict[str, int]:
+    """
+    Current and peak resident set size of this process in kB
+    """
+    current = 0
+    try:
+        with open('/proc/self/status', 'r', encoding='UTF-8') as file_handle:
+            for line in file_handle:
+                if line.startswith('VmRSS:'):
+                    current = int(line.split()[1])
+    except OSError:
+        pass
+    return {
+        'current_kb': current,
+        'peak_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def read_corpus(*pathes: str) -> list[bytes]:
+    file_names: list[str] = []
+    for path in pathes:
+        if os.path.isdir(path):
+            for dir_path, _dir_names, names in os.walk(path):
+                file_names.extend(
+                    os.path.join(dir_path, name) for name in names
+                    if valid_file_name(name)
+                )
+        else:
+            file_names.append(path)
+
+    mails: list[bytes] = []
+    for file_name in sorted(file_names):
+        with open(file_name, 'rb') as file_handle:
+            mails.append(file_handle.read())
+    return mails
+
+
+def create_corpus(count: int, seed: int = 0) -> list[bytes]:
+    """
+    Create simple mails of random words
+    """
+    rng = random.Random(seed)
+    return [
+        (
+            f"From: sender{i}@example.org\r\n"
+            f"To: test@example.com\r\n"
+            f"Subject: {' '.join(rng.choices(_WORDS, k=5))}\r\n"
+            f"Message-ID: <{i}@example.org>\r\n"
+            f"\r\n"
+            + '\r\n'.join(
+                ' '.join(rng.choices(_WORDS, k=12))
+                for _ in range(rng.randint(5, 60))
+            )
+            + '\r\n'
+        ).encode('ascii')
+        for i in range(count)
+    ]
+
+
+class _SinkHandler:
+    def __init__(self) -> None:
+        self.count = 0
+        self._lock = threading.Lock()
+
+    async def handle_DATA(self, server: SMTP, session: Session, envelope: Envelope):  # pylint: disable=invalid-name,unused-argument
+        with self._lock:
+            self.count += 1
+        return '250 OK'
+
+
+def _percentile(values: list[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * percent / 100), len(values) - 1)]
+
+
+def _send_mails(
+    port: int, mails: list[bytes], count: int, clients: int, mail_from: str, rcpt_to: str
+) -> tuple[list[float], int, float]:
+    latencies: list[float] = []
+    errors = 0
+    lock = threading.Lock()
+    next_index = 0
+
+    def client() -> None:
+        nonlocal errors, next_index
+        with smtplib.SMTP('localhost', port) as smtp:
+            while True:
+                with lock:
+                    index = next_index
+                    next_index += 1
+                if index >= count:
+                    return
+                start = time.perf_counter()
+                try:
+                    smtp.sendmail(mail_from, [rcpt_to], mails[index % len(mails)])
+                except smtplib.SMTPException:
+                    with lock:
+                        errors += 1
+                    smtp.rset()
+                    continue
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return (latencies, errors, time.perf_counter() - start)
+
+
+def benchmark_daemon(
+    mails: list[bytes], count: int, clients: int, rcpt_to: str, result_cache: bool
+) -> dict:
+    """
+    Send `count` mails through the daemon and measure them at the client
+    """
+    sink_handler = _SinkHandler()
+    sink_port = _get_free_port()
+    sink = Controller(sink_handler, hostname='localhost', port=sink_port)
+    sink.start()
+
+    daemon_port = _get_free_port()
+    daemon = AIFilterMailDaemon(
+        listen_socket=f'localhost:{daemon_port}',
+        next_peer=f'localhost:{sink_port}',
+        uid=os.getuid(),
+        gid=os.getgid(),
+    )
+    if not result_cache:
+        daemon.filter_daemon._result_cache = ResultCache(0, 0)  # pylint: disable=protected-access
+    daemon.filter_daemon.preload()
+    controller = daemon.get_controller()
+    controller.start()
+
+    try:
+        # warm up connections and caches
+        _send_mails(daemon_port, mails, min(clients, count), clients, 'bench@example.org', rcpt_to)
+        sink_handler.count = 0
+
+        latencies, errors, duration = _send_mails(
+            daemon_port, mails, count, clients, 'bench@example.org', rcpt_to
+        )
+    finally:
+        controller.stop()
+        sink.stop()
+        if daemon.classifier is not None:
+            daemon.classifier.shutdown()
+
+    return {
+        'messages': len(latencies),
+        'errors': errors,
+        'delivered': sink_handler.count,
+        'duration_s': duration,
+        'messages_per_s': len(latencies) / duration if duration > 0 else 0.0,
+        'latency_ms': {
+            'mean': statistics.fmean(latencies) * 1000 if latencies else 0.0,
+            'p50': _percentile(latencies, 50) * 1000,
+            'p99': _percentile(latencies, 99) * 1000,
+            'max': max(latencies, default=0.0) * 1000,
+        },
+        'rss': _get_rss(),
+    }
+
+
+def _time_stage(timings: dict[str, float], stage: str, function: Callable, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+    return result
+
+
+def benchmark_stages(mails: list[bytes]) -> dict:
+    """
+    Time the stages of classifying and forwarding each mail one by one
+    """
+    model = SpamDetectorModel()
+    # the stages are timed on the internals of the bayes models
+    assert isinstance(model, SpamDetectorModelBayesBase)
+    model.load_model()
+    parser = BytesParser(policy=policy.default)
+
+    sink_handler = _SinkHandler()
+    sink_port = _get_free_port()
+    sink = Controller(sink_handler, hostname='localhost', port=sink_port)
+    sink.start()
+
+    timings: dict[str, float] = {}
+
+    async def forward_all(datas: list[bytes]) -> None:
+        next_hop = NextHopPool(f'localhost:{sink_port}', 1, 30.0, 1000, 60.0)
+        start = time.perf_counter()
+        for data in datas:
+            await next_hop.deliver('bench@example.org', ['test@example.com'], data)
+        timings['forward'] = time.perf_counter() - start
+        await next_hop.close()
+
+    try:
+        datas: list[bytes] = []
+        for mail in mails:
+            message = _time_stage(
+                timings, 'parse', lambda m: convert_message(parser.parsebytes(m)), mail
+            )
+            content = _time_stage(timings, 'extract', read_mail, message)
+            features = _time_stage(
+                timings, 'vectorize', model.get_features, [content], model.vectorizer
+            )
+            if model.mapped is not None:
+                _time_stage(timings, 'predict', model.mapped.joint_log_likelihood, features)
+            else:
+                _time_stage(timings, 'predict', model.model.predict_joint_log_proba, features)
+            datas.append(splice_header_fields(mail, [(b'X-Benchmark', b'1')], None))
+
+        asyncio.run(forward_all(datas))
+    finally:
+        sink.stop()
+
+    total = sum(timings.values())
+    return {
+        stage: {
+            'total_s': duration,
+            'per_mail_ms': duration / len(mails) * 1000,
+            'share': duration / total if total > 0 else 0.0,
+        }
+        for stage, duration in timings.items()
+    }
+
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(
+        description="Benchmark the mail daemon end to end"
+    )
+    argument_parser.add_argument(
+        'pathes', nargs='*', help='Mail files or directories to send. Without them synthetic mails are used'
+    )
+    argument_parser.add_argument(
+        '-s', '--synthetic', type=int, default=500,
+        help='Number of synthetic mails to create if no pathes are given'
+    )
+    argument_parser.add_argument(
+        '-n', '--messages', type=int, default=1000,
+        help='Number of mails to send'
+    )
+    argument_parser.add_argument(
+        '-c', '--clients', type=int, default=8,
+        help='Number of concurrent SMTP clients'
+    )
+    argument_parser.add_argument(
+        '-r', '--rcpt', default='test@example.com',
+        help='Recipient of the mails, it has to pass RE_RECIPIENTS_FILTER'
+    )
+    argument_parser.add_argument(
+        '--result-cache', action='store_true',
+        help='Keep the result cache enabled, repeated mails are not classified again'
+    )
+    argument_parser.add_argument(
+        '-o', '--output', help='JSON file to write the results to'
+    )
+    args = argument_parser.parse_args()
+
+    corpus = read_corpus(*args.pathes) if args.pathes else create_corpus(args.synthetic)
+    print(f"Using {len(corpus)} mails")
+
+    results = {
+        'settings': {
+            'corpus': len(corpus),
+            'messages': args.messages,
+            'clients': args.clients,
+            'result_cache': args.result_cache,
+        },
+        'daemon': benchmark_daemon(
+            corpus, args.messages, args.clients, args.rcpt, args.result_cache
+        ),
+        'stages': benchmark_stages(corpus),
+    }
+
+    daemon_results = results['daemon']
+    print(
+        f"{daemon_results['messages']} mails ({daemon_results['errors']} errors)"
+        f" in {daemon_results['duration_s']:.2f}s:"
+        f" {daemon_results['messages_per_s']:.1f} mails/s,"
+        f" latency p50 {daemon_results['latency_ms']['p50']:.1f}ms"
+        f" p99 {daemon_results['latency_ms']['p99']:.1f}ms,"
+        f" RSS {daemon_results['rss']['current_kb'] / 1024:.1f}MB"
+    )
+    for stage_name, stage in results['stages'].items():
+        print(
+            f"{stage_name:>10}: {stage['per_mail_ms']:8.3f} ms/mail"
+            f" {stage['share'] * 100:5.1f}%"
+        )
+
+    if args.output:
+        with open(args.output, 'w', encoding='UTF-8') as output_file:
+            json.dump(results, output_file, indent=2)
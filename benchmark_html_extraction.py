@@ -0,0 +1,98 @@
+"""
+Compare the html extractors on the tokens they produce and on throughput
+"""
+
+import argparse
+import os
+import re
+import time
+from email import policy
+from email.message import EmailMessage
+from email.parser import BytesParser
+
+from constants import MAX_HTML_SIZE
+from text_extraction import HTML_EXTRACTORS
+from tools import get_limited_content, valid_file_name
+
+# the default token pattern of sklearn's vectorizers
+RE_TOKEN = re.compile(r'(?u)\b\w\w+\b')
+
+
+def read_html_bodies(*pathes: str) -> list[str]:
+    file_names: list[str] = []
+    for path in pathes:
+        if os.path.isdir(path):
+            for dir_path, _dir_names, names in os.walk(path):
+                file_names.extend(
+                    os.path.join(dir_path, name) for name in names
+                )
+        else:
+            file_names.append(path)
+
+    parser = BytesParser(policy=policy.default)
+    bodies: list[str] = []
+    for file_name in file_names:
+        if not valid_file_name(file_name):
+            continue
+        with open(file_name, 'rb') as fh:
+            message = parser.parse(fh)
+        if not isinstance(message, EmailMessage):
+            continue
+        body = message.get_body(preferencelist=('html',))
+        if isinstance(body, EmailMessage):
+            bodies.append(get_limited_content(body, MAX_HTML_SIZE))
+    return bodies
+
+
+def get_tokens(text: str) -> set[str]:
+    return set(RE_TOKEN.findall(text.lower()))
+
+
+def benchmark(bodies: list[str], repeat: int):
+    size = sum(len(body) for body in bodies) * repeat
+    tokens: dict[str, list[set[str]]] = {}
+
+    for name, extractor in HTML_EXTRACTORS.items():
+        start = time.perf_counter()
+        for _ in range(repeat):
+            texts = [extractor(body) for body in bodies]
+        duration = time.perf_counter() - start
+
+        tokens[name] = [get_tokens(text) for text in texts]
+        print(
+            f"{name:>10}: {len(bodies) * repeat / duration:10.1f} mails/s"
+            f" {size / duration / 1e6:8.2f} MB/s"
+            f" {sum(len(t) for t in tokens[name]) / len(bodies):8.1f} distinct tokens/mail"
+        )
+
+    names = list(tokens)
+    for i, name in enumerate(names):
+        for other_name in names[i + 1:]:
+            similarities = [
+                len(a & b) / len(a | b) if a | b else 1.0
+                for a, b in zip(tokens[name], tokens[other_name])
+            ]
+            print(
+                f"Token similarity {name}/{other_name} (Jaccard):"
+                f" mean {sum(similarities) / len(similarities):.3f}"
+                f" min {min(similarities):.3f}"
+            )
+
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(
+        description="Compare html extractors on mail files"
+    )
+    argument_parser.add_argument(
+        'pathes', nargs='+', help='Mail files or directories to read'
+    )
+    argument_parser.add_argument(
+        '-r', '--repeat', type=int, default=3,
+        help='Number of times to convert each mail'
+    )
+    args = argument_parser.parse_args()
+
+    html_bodies = read_html_bodies(*args.pathes)
+    print(f"Found {len(html_bodies)} html mails")
+    if html_bodies:
+        benchmark(html_bodies, args.repeat)
@@ -30,15 +30,34 @@ RE_RECIPIENTS_FILTER: list[tuple[str, bool]] = [
     (r'(?:test|huhu)\@example\.com', True),  # run for those addresses
 ]
 
+# Mails with a spam probability of at least this value are treated as spam.
+# The probability is added as '-Score' header field for policies downstream
+SPAM_THRESHOLD: float = 0.5
+
 # Prefix to prefix the subject of detected spam mails with
 SUBJECT_PREFIX: str | None = "*** AI-SPAM ***"
 
+# Forward mails by only rewriting their header block instead of parsing
+# and serializing the whole mail
+FORWARD_HEADER_SPLICE: bool = True
+
 # Prefix for added mail header fields
 MAIL_HEADER_FIELD_PREFIX = b"RL3-AI-Spam-Filter"
 
-# Languages to load stop words for
+# Extractor converting html mail bodies to text: 'fast' strips tags, 'html2text'
+# formats the text as markdown. The model has to be retrained after changing it
+HTML_TEXT_EXTRACTOR: str = 'fast'
+
+# Languages to load stop words for. The stop words are stored with a trained
+# model, so changing the languages only affects new models and models trained
+# from scratch
 STOP_WORD_LANGUANGES: list[str] = ["german", "english"]
 
+# Keep the features of sender, subject and body apart, so a word in the
+# subject is a different feature than the same word in the body. Models are
+# stored under a different name, so a new model has to be trained
+FEATURE_NAMESPACES: bool = False
+
 
 # Directory to store vocabularies and models in
 DATA_DIR: str = '/usr/local/lib/spamdetector/data'
@@ -49,9 +68,57 @@ LISTENING_SOCKET_DATA: str = '/run/ai-spamdetector/ai-spamdetector.sock'
 NEXT_PEER_SOCKET_DATA: str = './sink.sock'
 # NEXT_PEER_SOCKET_DATA: str = 'localhost:10026'
 
+# Number of processes accepting connections on the listening socket. Each
+# one has its own event loop and classifier
+SERVER_WORKERS: int = 1
+
+# Maximum number of connections to the next hop
+NEXT_PEER_MAX_CONNECTIONS: int = 4
+# Seconds to keep an unused connection to the next hop open
+NEXT_PEER_IDLE_TIMEOUT: float = 30.0
+# Number of mails to send over one connection before reconnecting
+NEXT_PEER_MAX_MESSAGES: int = 100
+# Seconds to wait for the next hop to answer
+NEXT_PEER_TIMEOUT: float = 60.0
+
+# Executor to classify mails in, either 'thread' or 'process'.
+# A process pool loads the model in each worker and uses all cores
+CLASSIFIER_EXECUTOR: str = 'thread'
+# Number of threads or processes classifying mails
+CLASSIFIER_WORKERS: int = 4
+# Maximum number of mails being classified or waiting for classification.
+# Further mails are answered with a temporary error (451) to be retried later
+CLASSIFIER_MAX_IN_FLIGHT: int = 32
+
+# Number of classification results of recently seen mails to keep, e.g. for
+# mails sent to many recipients. 0 disables the cache
+RESULT_CACHE_SIZE: int = 10_000
+# Seconds to keep a classification result
+RESULT_CACHE_TTL: float = 3600.0
+
+# Number of trained model generations to keep in DATA_DIR
+MODEL_GENERATIONS_KEEP: int = 3
+
+# Seconds between checks of the model files in DATA_DIR. The model is
+# reloaded if they changed. 0 disables checking, send SIGHUP to reload then
+MODEL_WATCH_INTERVAL: float = 0.0
+
+# When to load the model: 'before' loads and warms it up before accepting
+# connections, 'background' accepts connections while loading it and 'lazy'
+# loads it with the first mail. systemd is notified when the daemon is ready
+MODEL_PRELOAD: str = 'before'
+
+# Socket to serve metrics in Prometheus text format on via HTTP, either a
+# unix socket (containing a slash) or hostname:port. None disables metrics.
+# With more than one worker, each worker serves its metrics on the port
+# increased by the worker's index (or the unix socket with the index appended)
+METRICS_SOCKET_DATA: str | None = None
+# METRICS_SOCKET_DATA: str | None = 'localhost:9110'
+
 # LOG_FILE: str = './mail_filter.log'
 # LOG_FILE: str = LOG_FILE_CONSOLE
 LOG_FILE: str = LOG_FILE_SYSLOG
+# messages below the level are dropped for every log file, syslog included
 LOG_LEVEL: LogPriorityType = LOG_INFO
 
 LAST_LEARN_SEMAPHORE: str = f"{DATA_DIR}/last_learn.sem"
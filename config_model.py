@@ -1,6 +1,11 @@
 from typing import Type
 
 from models.base import SpamDetectorModelBase
-from models.tfid_multinominal_nb import SpamDetectorModelTfidMultinominal
+from models.hashing_multinominal_nb import SpamDetectorModelHashingMultinominal
 
-SpamDetectorModel: Type[SpamDetectorModelBase] = SpamDetectorModelTfidMultinominal
+# To weight the features by their IDF. The model cannot learn new mails only,
+# every training run learns all mails again:
+# from models.tfid_multinominal_nb import SpamDetectorModelTfidMultinominal
+# SpamDetectorModel: Type[SpamDetectorModelBase] = SpamDetectorModelTfidMultinominal
+
+SpamDetectorModel: Type[SpamDetectorModelBase] = SpamDetectorModelHashingMultinominal
@@ -6,8 +6,39 @@ NEW_MODEL: bool = False
 VOCABULARY_FILE_PREFIX = "vocabulary"
 VECTORIZER_FILE_EXT = ".pkl"
 
+VECTORIZER_STATE_FILE_PREFIX = "vectorizer-state"
+
+CALIBRATION_FILE_PREFIX = "calibration"
+CALIBRATION_FILE_EXT = ".json"
+
+# Model files are published as generations in DATA_DIR/generations and
+# DATA_DIR/current links to the current one
+GENERATIONS_DIR_NAME = "generations"
+CURRENT_GENERATION_LINK = "current"
+MANIFEST_FILE_NAME = "manifest.json"
+
+# Stop words the model was trained with
+STOP_WORDS_FILE_NAME = "stop-words.json"
+
+# Directory extension of models stored as memory mapped arrays
+MAPPED_MODEL_DIR_EXT = ".mapped"
+
+MAIL_CACHE_FILE_NAME = "mail-cache.sqlite"
+
 N_GRAMS: tuple[int, int] = (1, 2)
 
+# Number of features of models hashing tokens instead of using a vocabulary
+HASHING_N_FEATURES: int = 2 ** 20
+
+# Prefixes of the features of the MailContent fields (from, subject, body)
+# with FEATURE_NAMESPACES
+FIELD_NAMESPACES: tuple[str, ...] = ('from:', 'subject:', '')
+# File name suffix of models trained with FEATURE_NAMESPACES
+FIELD_NAMESPACES_SUFFIX = '-namespaces'
+
+# Labels of the trained classes
+LABELS: list[str] = ['ham', 'spam']
+
 # TextVectorizerType = Union[
 #    CountVectorizer,
 #    TfidfVectorizer,
@@ -19,10 +50,58 @@ N_GRAMS: tuple[int, int] = (1, 2)
 # ]
 # TEXT_MODEL_TYPE: Type[TextModelType] = MultinomialNB
 
+HTML_EXTRACTOR_FAST = 'fast'
+HTML_EXTRACTOR_HTML2TEXT = 'html2text'
+
+# Maximum number of characters of a mail body to extract
 MAX_SIZE = 50_000
+# Maximum number of characters of an html body to convert to text
+MAX_HTML_SIZE = 4 * MAX_SIZE
 TRAIN_CHUNK_SIZE = 1_000
+# Every n-th training mail is held out to calibrate the probabilities on and
+# learned after calibrating, up to CALIBRATION_MAX_MAILS mails
+CALIBRATION_HOLD_OUT = 10
+CALIBRATION_MAX_MAILS = TRAIN_CHUNK_SIZE
+# Minimum number of held out spam and of held out ham mails to calibrate on,
+# the calibration of the last run is kept with fewer
+CALIBRATION_MIN_MAILS = 20
+# Number of mail files to shuffle while scanning
+SHUFFLE_BUFFER_SIZE = 10 * TRAIN_CHUNK_SIZE
 
 SERVER_PORT_DEFAULT: int = 10025
 NEXT_PEER_PORT_DEFAULT: int = 10026
+METRICS_PORT_DEFAULT: int = 9110
+
+# Seconds to wait before restarting a worker process that exited
+WORKER_RESTART_DELAY: float = 1.0
 
+SMTP_ERROR_CODE_451 = 451
 SMTP_ERROR_CODE_554 = 554
+
+CLASSIFIER_EXECUTOR_THREAD = 'thread'
+CLASSIFIER_EXECUTOR_PROCESS = 'process'
+
+MODEL_PRELOAD_BEFORE = 'before'
+MODEL_PRELOAD_BACKGROUND = 'background'
+MODEL_PRELOAD_LAZY = 'lazy'
+
+# Defaults of settings added to config.example.py after the first release,
+# so configurations written before keep working without changes
+SPAM_THRESHOLD_DEFAULT: float = 0.5
+FORWARD_HEADER_SPLICE_DEFAULT: bool = True
+HTML_TEXT_EXTRACTOR_DEFAULT: str = HTML_EXTRACTOR_FAST
+FEATURE_NAMESPACES_DEFAULT: bool = False
+SERVER_WORKERS_DEFAULT: int = 1
+NEXT_PEER_MAX_CONNECTIONS_DEFAULT: int = 4
+NEXT_PEER_IDLE_TIMEOUT_DEFAULT: float = 30.0
+NEXT_PEER_MAX_MESSAGES_DEFAULT: int = 100
+NEXT_PEER_TIMEOUT_DEFAULT: float = 60.0
+CLASSIFIER_EXECUTOR_DEFAULT: str = CLASSIFIER_EXECUTOR_THREAD
+CLASSIFIER_WORKERS_DEFAULT: int = 4
+CLASSIFIER_MAX_IN_FLIGHT_DEFAULT: int = 32
+RESULT_CACHE_SIZE_DEFAULT: int = 10_000
+RESULT_CACHE_TTL_DEFAULT: float = 3600.0
+MODEL_GENERATIONS_KEEP_DEFAULT: int = 3
+MODEL_WATCH_INTERVAL_DEFAULT: float = 0.0
+MODEL_PRELOAD_DEFAULT: str = MODEL_PRELOAD_BEFORE
+METRICS_SOCKET_DATA_DEFAULT: str | None = None
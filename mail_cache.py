@@ -0,0 +1,115 @@
+"""
+Persistent cache of mail contents extracted from mail files
+"""
+
+import json
+import os
+import sqlite3
+import time
+
+from mail_logging import LOG_INFO
+from mail_logging.logging import log
+from mail_types import MailContent
+
+
+class MailContentCache:
+    """
+    Caches the contents read from mail files in a sqlite database
+
+    Entries are keyed by path and only used if size, modification time and
+    inode of the file did not change. The cache is emptied if the version of
+    the extraction differs from the one the entries were created with.
+    """
+
+    def __init__(self, file_name: str, version: str) -> None:
+        self.file_name = file_name
+        self.version = version
+        self.run_id = time.time_ns()
+        self.hits = 0
+        self.misses = 0
+        self._seen: list[tuple[int, str]] = []
+
+        self.connection = sqlite3.connect(file_name)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS mails (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                content TEXT NOT NULL,
+                seen INTEGER NOT NULL
+            );
+        ''')
+
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE key = 'version'"
+        ).fetchone()
+        if row is None or row[0] != version:
+            if row is not None:
+                log(LOG_INFO, f"Mail cache '{file_name}' is outdated. Clearing it.")
+            with self.connection:
+                self.connection.execute("DELETE FROM mails")
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)",
+                    (version,)
+                )
+
+    def get(self, path: str, stat: os.stat_result) -> MailContent | None:
+        row = self.connection.execute(
+            "SELECT size, mtime_ns, inode, content FROM mails WHERE path = ?",
+            (path,)
+        ).fetchone()
+        if row is None or tuple(row[:3]) != (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._seen.append((self.run_id, path))
+        return tuple(json.loads(row[3]))
+
+    def put(self, path: str, stat: os.stat_result, content: MailContent) -> None:
+        self.connection.execute(
+            "INSERT OR REPLACE INTO mails (path, size, mtime_ns, inode, content, seen) VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                path, stat.st_size, stat.st_mtime_ns, stat.st_ino,
+                json.dumps(content), self.run_id
+            )
+        )
+
+    def commit(self) -> None:
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE mails SET seen = ? WHERE path = ?", self._seen
+            )
+        self._seen = []
+
+    def evict(self) -> None:
+        """
+        Remove entries of files that do not exist anymore
+
+        Only entries not used in this run are checked.
+        """
+        self.commit()
+        deleted = [
+            (path,)
+            for (path,) in self.connection.execute(
+                "SELECT path FROM mails WHERE seen != ?", (self.run_id,)
+            ).fetchall()
+            if not os.path.exists(path)
+        ]
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM mails WHERE path = ?", deleted
+            )
+        log(
+            LOG_INFO,
+            f"Mail cache: {self.hits} hits, {self.misses} misses, {len(deleted)} evicted"
+        )
+
+    def close(self) -> None:
+        self.commit()
+        self.connection.close()
@@ -1,14 +1,22 @@
+import atexit
 import logging
 import os
+import queue
+import sys
 import syslog
+import threading
+import time
 from typing import Any
 
 from mail_logging import (LOG_DEBUG, LOG_ERROR, LOG_FILE_CONSOLE,
                           LOG_FILE_SYSLOG, LOG_INFO, LOG_WARN, LogPriorityType)
 
+# Seconds to wait for queued messages to be written at exit
+_SHUTDOWN_TIMEOUT = 5.0
+
 
 class _LogBase:
-    def log(self, priority: LogPriorityType, message: str) -> None:
+    def log(self, priority: LogPriorityType, message: str, created: float) -> None:
         raise NotImplementedError
 
 
@@ -22,7 +30,7 @@ class _LogSyslog(_LogBase):
             LOG_ERROR: syslog.LOG_ERR,
         }
 
-    def log(self, priority: LogPriorityType, message: str) -> None:
+    def log(self, priority: LogPriorityType, message: str, created: float) -> None:
         syslog.syslog(
             self.level_mapper.get(priority, priority),
             message
@@ -45,43 +53,144 @@ class _LogFile(_LogBase):
             format='%(asctime)s %(levelname)s %(message)s',
             datefmt='%Y-%m-%d %H:%M:%S',
         )
+        self.logger = logging.getLogger()
 
-    def log(self, priority: LogPriorityType, message: str) -> None:
-        logging.log(
-            level=self.level_mapper.get(priority, logging.INFO),
-            msg=message
+    def log(self, priority: LogPriorityType, message: str, created: float) -> None:
+        record = self.logger.makeRecord(
+            self.logger.name, self.level_mapper.get(priority, logging.INFO),
+            fn='', lno=0, msg=message, args=(), exc_info=None,
         )
+        # time of logging, not of writing
+        record.created = created
+        self.logger.handle(record)
 
 
 class _LogConsole(_LogBase):
-    def __init__(self, log_level: LogPriorityType) -> None:
-        super().__init__()
-        self.log_level = log_level
-
-    def log(self, priority: LogPriorityType, message: str) -> None:
-        if priority >= self.log_level:
-            print(message)
-
-
-_logger: _LogBase = _LogConsole(LOG_INFO)
-
-
-def log(priority: LogPriorityType, *messages: Any):
-    _logger.log(
-        priority=priority,
-        message=(
-            f"[{os.getpid()}] " +
-            ' '.join(str(message) for message in messages)
-        )
-    )
+    def log(self, priority: LogPriorityType, message: str, created: float) -> None:
+        print(message, flush=True)
+
+
+class _LogQueue:
+    """
+    Writes messages to a log in a background thread, so writing never blocks
+    the event loop
+
+    Messages are written directly when the thread is not running.
+    """
+
+    def __init__(self, logger: _LogBase) -> None:
+        self.logger = logger
+        self._queue: queue.Queue[tuple[LogPriorityType, str, float] | None] = queue.Queue()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            entry = self._queue.get()
+            try:
+                if entry is None:
+                    return
+                self.logger.log(*entry)
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                print(f"Writing log failed: {error}", file=sys.stderr)
+            finally:
+                self._queue.task_done()
+
+    def log(self, priority: LogPriorityType, message: str, created: float) -> None:
+        if self._thread is None:
+            self.logger.log(priority, message, created)
+            return
+        self._queue.put((priority, message, created))
+
+    def flush(self) -> None:
+        """
+        Wait until all queued messages are written
+        """
+        if self._thread is not None:
+            self._queue.join()
+
+    def after_fork(self) -> None:
+        """
+        Start a new thread in a forked process, the thread is not forked
+        """
+        if self._thread is not None:
+            # messages queued before the fork are written by the parent
+            self._queue = queue.Queue()
+            self.start()
+
+    def stop(self) -> None:
+        """
+        Write the queued messages and stop the thread
+        """
+        if self._thread is None:
+            return
+        thread, self._thread = self._thread, None
+        self._queue.put(None)
+        thread.join(_SHUTDOWN_TIMEOUT)
+
+
+_logger = _LogQueue(_LogConsole())
+_log_level: LogPriorityType = LOG_INFO
+_pid = os.getpid()
+
+
+def is_log_enabled(priority: LogPriorityType) -> bool:
+    """
+    Check if messages of a priority are logged, to skip building expensive
+    log arguments
+    """
+    return priority >= _log_level
+
+
+def log(priority: LogPriorityType, message: Any, *args: Any) -> None:
+    """
+    Log a message if its priority reaches the log level
+
+    Args:
+        priority (LogPriorityType): priority of the message
+        message (Any): message, formatted %-style with `args` if given. Messages
+            below the log level are not formatted at all
+    """
+    if priority < _log_level:
+        return
+    text = str(message) % args if args else str(message)
+    _logger.log(priority, f"[{_pid}] {text}", time.time())
+
+
+def flush_logger() -> None:
+    _logger.flush()
+
+
+def shutdown_logger() -> None:
+    """
+    Write all queued messages, log synchronously from now on
+    """
+    _logger.stop()
+
+
+def _after_fork_in_child() -> None:
+    global _pid  # pylint: disable=global-statement
+    _pid = os.getpid()
+    _logger.after_fork()
 
 
 def init_logger(log_file: str, log_level: LogPriorityType = LOG_INFO) -> None:
-    global _logger
-    _logger = (
+    global _logger, _log_level  # pylint: disable=global-statement
+    _logger.stop()
+    _log_level = log_level
+    _logger = _LogQueue(
         _LogSyslog()
         if log_file == LOG_FILE_SYSLOG
-        else _LogConsole(log_level)
+        else _LogConsole()
         if log_file == LOG_FILE_CONSOLE
         else _LogFile(log_file, log_level)
     )
+    _logger.start()
+
+
+atexit.register(shutdown_logger)
+# no message is written while forking and the child gets its own thread
+os.register_at_fork(before=flush_logger, after_in_child=_after_fork_in_child)
@@ -1,5 +1,19 @@
 
-from typing import Tuple
+from typing import NamedTuple, Tuple
 
 MailContent = Tuple[str, ...]
 
+
+class ClassificationResult(NamedTuple):
+    is_spam: bool
+    # 'SPAM' or 'HAM'
+    label: str
+    # probability of the mail being spam
+    score: float
+    # seconds spent in each stage of the classification
+    stages: tuple[tuple[str, float], ...] = ()
+    # the score was taken from the result cache
+    cached: bool = False
+    # generation of the model used
+    generation: str | None = None
+
@@ -0,0 +1,247 @@
+"""
+Counters, gauges and histograms of the daemon served in Prometheus text format
+"""
+
+import asyncio
+import bisect
+import os
+import stat
+import threading
+from typing import Callable
+
+from constants import METRICS_PORT_DEFAULT
+from mail_logging import LOG_DEBUG, LOG_INFO
+from mail_logging.logging import log
+
+LabelsType = tuple[str, ...]
+
+# Upper bounds in seconds of the stage duration buckets
+DURATION_BUCKETS: tuple[float, ...] = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+
+def _format_labels(names: LabelsType, values: LabelsType, extra: str = '') -> str:
+    labels = [
+        f'{name}="{value}"'
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type_name = ''
+
+    def __init__(self, name: str, help_text: str, label_names: LabelsType = ()) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._lock = threading.Lock()
+
+    def render(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} {self.type_name}",
+        ] + self._render_samples()
+
+    def _render_samples(self) -> list[str]:
+        raise NotImplementedError()
+
+
+class Counter(_Metric):
+    type_name = 'counter'
+
+    def __init__(self, name: str, help_text: str, label_names: LabelsType = ()) -> None:
+        super().__init__(name, help_text, label_names)
+        self._values: dict[LabelsType, float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def _render_samples(self) -> list[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [
+            f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}"
+            for labels, value in values
+        ]
+
+
+class Gauge(_Metric):
+    type_name = 'gauge'
+
+    def __init__(self, name: str, help_text: str, label_names: LabelsType = ()) -> None:
+        super().__init__(name, help_text, label_names)
+        self._values: dict[LabelsType, float] = {}
+        self._function: Callable[[], float] | None = None
+
+    def set(self, value: float, *label_values: str) -> None:
+        with self._lock:
+            self._values[label_values] = value
+
+    def set_info(self, *label_values: str) -> None:
+        """
+        Set the only sample of an info gauge to 1
+        """
+        with self._lock:
+            self._values = {label_values: 1}
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """
+        Get the value when rendering instead
+        """
+        self._function = function
+
+    def _render_samples(self) -> list[str]:
+        if self._function is not None:
+            return [f"{self.name} {_format_value(self._function())}"]
+        with self._lock:
+            values = list(self._values.items())
+        return [
+            f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}"
+            for labels, value in values
+        ]
+
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def __init__(
+        self, name: str, help_text: str, label_names: LabelsType = (),
+        buckets: tuple[float, ...] = DURATION_BUCKETS,
+    ) -> None:
+        super().__init__(name, help_text, label_names)
+        self.buckets = buckets
+        # counts per bucket (not cumulative), count of the +Inf bucket last, and sum
+        self._values: dict[LabelsType, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *label_values: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(
+                label_values, ([0] * (len(self.buckets) + 1), [0.0])
+            )
+            counts[index] += 1
+            total[0] += value
+
+    def _render_samples(self) -> list[str]:
+        with self._lock:
+            values = [
+                (labels, list(counts), total[0])
+                for labels, (counts, total) in self._values.items()
+            ]
+
+        lines: list[str] = []
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                bucket_label = f'le="{_format_value(bound)}"'
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(self.label_names, labels, bucket_label)} {cumulative}"
+                )
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+
+STAGE_SECONDS = Histogram(
+    'spamdetector_stage_seconds',
+    'Time spent per mail in each stage of handling it',
+    ('stage',),
+)
+MAILS = Counter(
+    'spamdetector_mails_total',
+    'Mails handled by result: spam, ham, untested (model failed), skipped (no recipient to check) or deferred (queue full)',
+    ('result',),
+)
+CLASSIFIER_IN_FLIGHT = Gauge(
+    'spamdetector_classifier_in_flight',
+    'Mails being classified or waiting for classification',
+)
+RESULT_CACHE = Counter(
+    'spamdetector_result_cache_total',
+    'Lookups in the classification result cache by outcome',
+    ('outcome',),
+)
+MODEL_GENERATION = Gauge(
+    'spamdetector_model_generation_info',
+    'Generation of the model mails were last classified with',
+    ('generation',),
+)
+
+METRICS: list[_Metric] = [
+    STAGE_SECONDS, MAILS, CLASSIFIER_IN_FLIGHT, RESULT_CACHE, MODEL_GENERATION,
+]
+
+
+def render() -> str:
+    return '\n'.join(
+        line for metric in METRICS for line in metric.render()
+    ) + '\n'
+
+
+async def _handle_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        # the request is not relevant, every path gets the metrics
+        while await asyncio.wait_for(reader.readline(), 10) not in (b'\r\n', b'\n', b''):
+            pass
+        body = render().encode('utf-8')
+        writer.write(
+            b'HTTP/1.0 200 OK\r\n'
+            b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+            + f'Content-Length: {len(body)}\r\n\r\n'.encode('ascii')
+            + body
+        )
+        await writer.drain()
+    except (OSError, asyncio.TimeoutError) as e:  # pylint: disable=invalid-name
+        log(LOG_DEBUG, f"Metrics request failed: {e}")
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(socket_data: str) -> asyncio.AbstractServer:
+    """
+    Serve the metrics over HTTP
+
+    Args:
+        socket_data (str): unix socket if it contains a slash, else hostname
+            with an optional port separated by a colon
+    """
+    if socket_data.find('/') >= 0:
+        log(LOG_INFO, f"Serving metrics on socket {socket_data}")
+        try:
+            # only replace a socket left over by an earlier run, never a file
+            if stat.S_ISSOCK(os.lstat(socket_data).st_mode):
+                os.unlink(socket_data)
+        except FileNotFoundError:
+            pass
+        return await asyncio.start_unix_server(
+            _handle_request, path=os.path.abspath(socket_data)
+        )
+
+    hostname, _, port = socket_data.partition(':')
+    log(LOG_INFO, f"Serving metrics on {hostname}:{port}")
+    return await asyncio.start_server(
+        _handle_request, host=hostname, port=int(port) if port else METRICS_PORT_DEFAULT
+    )
+
+
+def get_worker_socket_data(socket_data: str, index: int) -> str:
+    """
+    Get the metrics socket of a worker process: the port is increased by the
+    worker's index, a unix socket gets the index appended
+    """
+    if socket_data.find('/') >= 0:
+        return f"{socket_data}.{index}"
+    hostname, _, port = socket_data.partition(':')
+    return f"{hostname}:{(int(port) if port else METRICS_PORT_DEFAULT) + index}"
@@ -0,0 +1,192 @@
+"""
+Versioned model generations published atomically in the data directory
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from constants import (CURRENT_GENERATION_LINK, GENERATIONS_DIR_NAME,
+                       MANIFEST_FILE_NAME)
+from mail_logging import LOG_DEBUG, LOG_ERROR, LOG_INFO, LOG_WARN
+from mail_logging.logging import log
+
+_TEMP_PREFIX = '.tmp-'
+# Age in seconds of a temporary generation to be considered left over by a crash
+_TEMP_MAX_AGE = 24 * 60 * 60
+
+
+def _get_checksum(file_name: str) -> str:
+    with open(file_name, 'rb') as file_handle:
+        return hashlib.file_digest(file_handle, 'sha256').hexdigest()
+
+
+def _fsync_dir(dir_name: str) -> None:
+    fd = os.open(dir_name, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class ModelGenerations:
+    """
+    Model files of one training run are written to a temporary directory and
+    published as a generation by renaming it into `generations/` and
+    replacing the `current` symlink.
+
+    A manifest lists the files of a generation with their sizes and
+    checksums, so files of different training runs are never mixed.
+    """
+
+    def __init__(self, data_dir: str, keep: int) -> None:
+        # real path to compare with the target of the current link
+        self.data_dir = os.path.realpath(data_dir)
+        self.generations_dir = os.path.join(self.data_dir, GENERATIONS_DIR_NAME)
+        self.current_link = os.path.join(self.data_dir, CURRENT_GENERATION_LINK)
+        self.keep = max(keep, 1)
+
+    def current(self) -> str | None:
+        """
+        Get the directory of the current generation
+
+        Returns:
+            str | None: directory or None if no generation has been published
+        """
+        if not os.path.islink(self.current_link):
+            return None
+        dir_name = os.path.realpath(self.current_link)
+        if not os.path.isfile(os.path.join(dir_name, MANIFEST_FILE_NAME)):
+            log(LOG_ERROR, f"Current model generation '{dir_name}' has no manifest")
+            return None
+        return dir_name
+
+    @staticmethod
+    def read_manifest(dir_name: str) -> dict:
+        with open(os.path.join(dir_name, MANIFEST_FILE_NAME), 'r', encoding='UTF-8') as file_handle:
+            return json.load(file_handle)
+
+    @staticmethod
+    def get_files(dir_name: str) -> list[str]:
+        """
+        Get the files of a generation including its manifest
+        """
+        manifest = ModelGenerations.read_manifest(dir_name)
+        return [os.path.join(dir_name, MANIFEST_FILE_NAME)] + [
+            os.path.join(dir_name, file_name) for file_name in manifest['files']
+        ]
+
+    @staticmethod
+    def verify(dir_name: str, checksums: bool = False) -> bool:
+        """
+        Check that the files of a generation match its manifest
+
+        Args:
+            dir_name (str): directory of the generation
+            checksums (bool): compare the checksums of the files too instead
+                of only their sizes. This reads every file of the generation
+        """
+        try:
+            manifest = ModelGenerations.read_manifest(dir_name)
+            # manifests written before sizes were added have checksums only
+            sizes: dict[str, int] = manifest.get('sizes', {})
+            for file_name, checksum in manifest['files'].items():
+                path = os.path.join(dir_name, file_name)
+                size = os.path.getsize(path)
+                if file_name in sizes and size != sizes[file_name]:
+                    log(LOG_ERROR, f"Size of '{file_name}' in model generation '{dir_name}' does not match")
+                    return False
+                if checksums and _get_checksum(path) != checksum:
+                    log(LOG_ERROR, f"Checksum of '{file_name}' in model generation '{dir_name}' does not match")
+                    return False
+        except (OSError, ValueError, KeyError) as e:  # pylint: disable=invalid-name
+            log(LOG_ERROR, f"Verifying model generation '{dir_name}' failed: {e}")
+            return False
+        return True
+
+    def create(self) -> str:
+        """
+        Create a temporary directory to write the files of a new generation to
+        """
+        os.makedirs(self.generations_dir, exist_ok=True)
+        generation = f"{time.strftime('%Y%m%d-%H%M%S')}-{time.time_ns() % 1_000_000_000:09d}"
+        dir_name = os.path.join(self.generations_dir, f"{_TEMP_PREFIX}{generation}")
+        os.mkdir(dir_name)
+        return dir_name
+
+    def publish(self, temp_dir: str) -> str:
+        """
+        Write the manifest of a generation and make it the current one
+
+        Args:
+            temp_dir (str): directory returned by `create`
+
+        Returns:
+            str: directory of the published generation
+        """
+        generation = os.path.basename(temp_dir)[len(_TEMP_PREFIX):]
+        files: dict[str, str] = {}
+        sizes: dict[str, int] = {}
+        for dir_path, _dir_names, file_names in os.walk(temp_dir):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                with open(path, 'rb') as file_handle:
+                    os.fsync(file_handle.fileno())
+                files[os.path.relpath(path, temp_dir)] = _get_checksum(path)
+                sizes[os.path.relpath(path, temp_dir)] = os.path.getsize(path)
+
+        manifest_file_name = os.path.join(temp_dir, MANIFEST_FILE_NAME)
+        with open(manifest_file_name, 'w', encoding='UTF-8') as file_handle:
+            json.dump(
+                {
+                    'generation': generation,
+                    'created': time.time(),
+                    'files': dict(sorted(files.items())),
+                    'sizes': dict(sorted(sizes.items())),
+                },
+                file_handle,
+                indent=2,
+            )
+            file_handle.flush()
+            os.fsync(file_handle.fileno())
+
+        dir_name = os.path.join(self.generations_dir, generation)
+        os.rename(temp_dir, dir_name)
+
+        temp_link = f"{self.current_link}{_TEMP_PREFIX}{generation}"
+        os.symlink(os.path.relpath(dir_name, self.data_dir), temp_link)
+        os.replace(temp_link, self.current_link)
+        _fsync_dir(self.generations_dir)
+        _fsync_dir(self.data_dir)
+        log(LOG_INFO, f"Published model generation '{generation}'")
+
+        self.cleanup()
+        return dir_name
+
+    def discard(self, temp_dir: str) -> None:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def cleanup(self) -> None:
+        """
+        Remove old generations and temporary directories left over by crashes
+        """
+        current = self.current()
+        generations: list[str] = []
+        now = time.time()
+        for entry in os.scandir(self.generations_dir):
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+            if entry.name.startswith(_TEMP_PREFIX):
+                if now - entry.stat().st_mtime > _TEMP_MAX_AGE:
+                    log(LOG_WARN, f"Removing left over model generation '{entry.path}'")
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                continue
+            if os.path.realpath(entry.path) != current:
+                generations.append(entry.path)
+
+        # the current generation is kept as well
+        for dir_name in sorted(generations)[:max(len(generations) - self.keep + 1, 0)]:
+            log(LOG_DEBUG, f"Removing old model generation '{dir_name}'")
+            shutil.rmtree(dir_name, ignore_errors=True)
@@ -3,9 +3,16 @@ from mail_types import MailContent
 
 
 class SpamDetectorModelBase():
+    # Models weighting features by all mails learned (IDF) cannot continue
+    # learning a saved model. They are trained from scratch, first learning
+    # the vocabulary of all mails, then the mails.
+    incremental: bool = True
+
     def __init__(self, for_training: bool = False) -> None:
         self.lock = threading.RLock()
         self.for_training = for_training
+        # generation of the loaded model, None for files directly in DATA_DIR
+        self.generation: str | None = None
 
     def reload(self) -> None:
         self.load_model()
@@ -16,8 +23,41 @@ class SpamDetectorModelBase():
     def save_model(self) -> None:
         raise NotImplementedError()
 
+    def get_model_files(self) -> list[str]:
+        """
+        Get the files the model is loaded from
+        """
+        raise NotImplementedError()
+
+    def is_new(self) -> bool:
+        """
+        Check if the model has not learned any mails yet
+        """
+        raise NotImplementedError()
+
+    def learn_vocabulary(self, contents: list[MailContent]) -> None:
+        """
+        Learn the vocabulary of mails before learning the mails, only used for
+        models that are not `incremental`
+        """
+        raise NotImplementedError()
+
     def learn_mails(self, contents: list[MailContent], labels: list[str]) -> None:
         raise NotImplementedError()
 
-    def predict_mail(self, content: MailContent) -> bool:
+    def predict_mail(self, content: MailContent, timings: dict[str, float] | None = None) -> float:
+        """
+        Predict the probability of a mail being spam
+
+        Args:
+            content (MailContent): mail to score
+            timings (dict[str, float] | None): gets the seconds spent in
+                the stages 'vectorize' and 'predict' if given
+        """
+        raise NotImplementedError()
+
+    def predict_mails(self, contents: list[MailContent]) -> list[bool]:
+        raise NotImplementedError()
+
+    def predict_proba_mails(self, contents: list[MailContent], timings: dict[str, float] | None = None) -> list[float]:
         raise NotImplementedError()
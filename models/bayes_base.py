@@ -1,45 +1,76 @@
+import json
 import os
 import pickle
-from itertools import chain
+import time
 from sqlite3 import OperationalError
-from typing import Callable, Generic, Iterable, TypeVar
+from typing import Any, Callable, Generic, Iterable, TypeVar
 
+import numpy as np
 import sklearn.feature_extraction.text  # type:ignore
-from nltk import download  # type:ignore
-from nltk.corpus import stopwords  # type:ignore
+from scipy.sparse import csr_matrix  # type: ignore
+from scipy.special import logsumexp  # type: ignore
 from sklearn.feature_extraction.text import CountVectorizer  # type: ignore
-from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfVectorizer
 from sklearn.naive_bayes import MultinomialNB  # type: ignore
+from sklearn.preprocessing import normalize  # type: ignore
 from sklearn.svm import SVC  # type: ignore
 
+import config
 from config import DATA_DIR, STOP_WORD_LANGUANGES
-from constants import (MODEL_FILE_EXT, MODEL_FILE_PREFIX, N_GRAMS,
-                       VECTORIZER_FILE_EXT, VOCABULARY_FILE_PREFIX)
+from constants import (CALIBRATION_FILE_EXT, CALIBRATION_FILE_PREFIX,
+                       CALIBRATION_HOLD_OUT, CALIBRATION_MAX_MAILS,
+                       CALIBRATION_MIN_MAILS, FEATURE_NAMESPACES_DEFAULT,
+                       FIELD_NAMESPACES, FIELD_NAMESPACES_SUFFIX, LABELS,
+                       MAPPED_MODEL_DIR_EXT, MODEL_FILE_EXT,
+                       MODEL_FILE_PREFIX, MODEL_GENERATIONS_KEEP_DEFAULT,
+                       N_GRAMS, SPAM_THRESHOLD_DEFAULT, STOP_WORDS_FILE_NAME,
+                       VECTORIZER_FILE_EXT, VECTORIZER_STATE_FILE_PREFIX,
+                       VOCABULARY_FILE_PREFIX)
 from mail_logging import LOG_DEBUG, LOG_ERROR, LOG_INFO, LOG_WARN
 from mail_logging.logging import log
 from mail_types import MailContent
+from model_generations import ModelGenerations
 from models.base import SpamDetectorModelBase
+from models.calibration import Calibration
+from models.mapped_model import MappedModel
 
-VectorizerType = TypeVar('VectorizerType', CountVectorizer, TfidfVectorizer)
+# settings missing in configurations written before they were added
+FEATURE_NAMESPACES: bool = getattr(config, 'FEATURE_NAMESPACES', FEATURE_NAMESPACES_DEFAULT)
+MODEL_GENERATIONS_KEEP: int = getattr(config, 'MODEL_GENERATIONS_KEEP', MODEL_GENERATIONS_KEEP_DEFAULT)
+SPAM_THRESHOLD: float = getattr(config, 'SPAM_THRESHOLD', SPAM_THRESHOLD_DEFAULT)
+
+VectorizerType = TypeVar(
+    'VectorizerType', CountVectorizer, TfidfVectorizer, HashingVectorizer
+)
 ModelType = TypeVar('ModelType', SVC, MultinomialNB)
 
 STRIP_ACCENTS = sklearn.feature_extraction.text.strip_accents_unicode
 
 
-def ___closure1() -> Callable[[], list[str]]:
+def ___closure1() -> Callable[[], frozenset[str]]:
 
-    _stop_words: list[str] | None = None
+    _stop_words: frozenset[str] | None = None
 
     def _get_stop_words():
+        """
+        Get the stop words of STOP_WORD_LANGUANGES from nltk
+
+        Only needed to train a new model, trained models store their stop words.
+        """
         nonlocal _stop_words
         if _stop_words is not None:
             return _stop_words
 
-        download('stopwords')
-        _stop_words = [
-            STRIP_ACCENTS(word)
-            for word in stopwords.words(STOP_WORD_LANGUANGES)  # type:ignore
-        ]
+        # pylint: disable=import-outside-toplevel
+        from nltk import download  # type:ignore
+        from nltk.corpus import stopwords  # type:ignore
+
+        try:
+            words = stopwords.words(STOP_WORD_LANGUANGES)  # type:ignore
+        except LookupError:
+            download('stopwords')
+            words = stopwords.words(STOP_WORD_LANGUANGES)  # type:ignore
+        _stop_words = frozenset(STRIP_ACCENTS(word) for word in words)
         return _stop_words
 
     return _get_stop_words
@@ -50,27 +81,136 @@ get_stop_words = ___closure1()
 
 class SpamDetectorModelBayesBase(SpamDetectorModelBase, Generic[VectorizerType, ModelType]):
     def __init__(self, vectorizer_class: type[VectorizerType], model_class: type[ModelType], for_training: bool = False) -> None:
-        super().__init__()
+        super().__init__(for_training=for_training)
         self.vectorizer_class: type[VectorizerType] = vectorizer_class
         self.model_class: type[ModelType] = model_class
         self.vocabulary: dict[str, int]
         self.vectorizer: VectorizerType
         self.model: ModelType
+        self.generations = ModelGenerations(DATA_DIR, MODEL_GENERATIONS_KEEP)
+        # directory the model files are loaded from and saved to
+        self.model_dir: str = os.path.abspath(DATA_DIR)
+        # memory mapped model used instead of vocabulary and model for predictions
+        self.mapped: MappedModel | None = None
+        # number of documents and per feature document counts seen while training
+        self.document_count: int = 0
+        self.document_frequencies: np.ndarray = np.zeros(0, dtype=np.int64)
+        self.stop_words: frozenset[str] = frozenset()
+        self.calibration: Calibration = Calibration()
+        # mails held out of training to fit the calibration on when saving
+        self.held_out_contents: list[MailContent] = []
+        self.held_out_labels: list[str] = []
+        self.training_mails: int = 0
+        # the vocabulary of all mails to learn has been learned before
+        self.vocabulary_learned: bool = False
         self.initialized: bool = False
 
     def load_model(self):
         with self.lock:
-            self.vocabulary, self.model = self._get_vocabulary_model(
-                self.for_training)
-            self.vectorizer = self.vectorizer_class(
-                ngram_range=N_GRAMS,
-                strip_accents=STRIP_ACCENTS,
-                decode_error='ignore',
-                vocabulary=self.vocabulary,
-                stop_words=get_stop_words(),
-            )
+            self.model_dir, self.generation = self._get_current_model_dir()
+            self.stop_words = self._load_stop_words()
+            self.calibration = self._load_calibration()
+            if not self.for_training:
+                self.mapped = self._load_mapped_model()
+                if self.mapped is not None:
+                    # the vectorizer is only used for its analyzer
+                    self.vocabulary = {}
+                    self.vectorizer = self._create_vectorizer()
+                    self.initialized = True
+                    return
+
+            if self.for_training and not self.incremental:
+                # trained from scratch
+                self.vocabulary, self.model = ({}, self.model_class())
+                self.document_count, self.document_frequencies = (0, np.zeros(0, dtype=np.int64))
+            else:
+                self.vocabulary, self.model = self._get_vocabulary_model(
+                    self.for_training)
+                self.document_count, self.document_frequencies = self._load_vectorizer_state()
+            if self.for_training and not hasattr(self.model, 'classes_'):
+                # a new model uses the stop words of STOP_WORD_LANGUANGES
+                log(LOG_INFO, f"Using stop words of {', '.join(STOP_WORD_LANGUANGES)} from nltk")
+                self.stop_words = get_stop_words()
+            self.vectorizer = self._create_vectorizer()
             self.initialized = True
 
+    def is_new(self) -> bool:
+        with self.lock:
+            self._get_model_vectorizer()
+            return not hasattr(self.model, 'classes_')
+
+    def _get_current_model_dir(self) -> tuple[str, str | None]:
+        """
+        Get the directory and generation of the current model
+
+        Models trained before generations were introduced are loaded from
+        DATA_DIR directly.
+
+        Only the sizes of the files are checked when loading for predictions,
+        so mapping the model stays fast. Training reads all files anyway and
+        compares their checksums.
+
+        Raises:
+            OperationalError: if the files do not match the manifest
+        """
+        dir_name = self.generations.current()
+        if dir_name is None:
+            return (os.path.abspath(DATA_DIR), None)
+
+        if not self.generations.verify(dir_name, checksums=self.for_training):
+            raise OperationalError(f"Model generation '{dir_name}' is corrupt")
+        generation = str(self.generations.read_manifest(dir_name)['generation'])
+        log(LOG_INFO, f"Using model generation '{generation}'")
+        return (dir_name, generation)
+
+    def _create_vectorizer(self) -> VectorizerType:
+        """
+        Create a fitted vectorizer for the current vocabulary
+
+        The vocabulary is fixed and the IDF weights (if any) are taken from the
+        document frequencies collected while training, so the vectorizer can be
+        used with `transform` only.
+        """
+        vectorizer = self.vectorizer_class(
+            ngram_range=N_GRAMS,
+            strip_accents=STRIP_ACCENTS,
+            decode_error='ignore',
+            vocabulary=self.vocabulary,
+            stop_words=sorted(self.stop_words),
+        )
+        if isinstance(vectorizer, TfidfVectorizer) and len(self.vocabulary) > 0:
+            vectorizer.idf_ = self._get_idf()
+        return vectorizer
+
+    def _get_idf(self) -> np.ndarray:
+        """
+        Calculate smoothed IDF weights like TfidfTransformer does
+
+        Without training state every weight is 1. This is what refitting the
+        vectorizer on a single document used to produce.
+        """
+        n_features = len(self.vocabulary)
+        if self.document_count == 0:
+            if not self.for_training:
+                log(LOG_WARN, "No document frequencies found. Using IDF weights of 1.")
+            return np.ones(n_features, dtype=np.float64)
+
+        document_frequencies = self._get_document_frequencies(n_features)
+        return np.log(
+            (1 + self.document_count) / (1 + document_frequencies)
+        ) + 1
+
+    def _get_document_frequencies(self, n_features: int) -> np.ndarray:
+        if len(self.document_frequencies) < n_features:
+            self.document_frequencies = np.concatenate((
+                self.document_frequencies,
+                np.zeros(
+                    n_features - len(self.document_frequencies),
+                    dtype=np.int64
+                ),
+            ))
+        return self.document_frequencies[:n_features]
+
     def _get_model_vectorizer(self) -> tuple[ModelType, VectorizerType]:
         with self.lock:
             if not self.initialized:
@@ -108,18 +248,81 @@ class SpamDetectorModelBayesBase(SpamDetectorModelBase, Generic[VectorizerType,
 
         return (vocabulary, model)
 
+    def _get_vectorizer_name(self) -> str:
+        return self.vectorizer_class.__name__
+
+    def _get_features_name(self) -> str:
+        """
+        Get the part of the file names depending on how features are extracted
+        """
+        suffix = FIELD_NAMESPACES_SUFFIX if FEATURE_NAMESPACES else ''
+        return f"{self._get_vectorizer_name()}-{N_GRAMS}{suffix}"
+
     def _get_model_file_name(self) -> str:
         return os.path.join(
-            os.path.abspath(DATA_DIR),
-            f"{MODEL_FILE_PREFIX}-{self.model_class.__name__}-{self.vectorizer_class.__name__}-{N_GRAMS}{MODEL_FILE_EXT}"
+            self.model_dir,
+            f"{MODEL_FILE_PREFIX}-{self.model_class.__name__}-{self._get_features_name()}{MODEL_FILE_EXT}"
         )
 
     def _get_vocabulary_file_name(self) -> str:
         return os.path.join(
-            os.path.abspath(DATA_DIR),
-            f"{VOCABULARY_FILE_PREFIX}-{self.vectorizer_class.__name__}-{N_GRAMS}{VECTORIZER_FILE_EXT}"
+            self.model_dir,
+            f"{VOCABULARY_FILE_PREFIX}-{self._get_features_name()}{VECTORIZER_FILE_EXT}"
+        )
+
+    def _get_vectorizer_state_file_name(self) -> str:
+        return os.path.join(
+            self.model_dir,
+            f"{VECTORIZER_STATE_FILE_PREFIX}-{self._get_features_name()}{VECTORIZER_FILE_EXT}"
+        )
+
+    def _get_calibration_file_name(self) -> str:
+        return os.path.join(
+            self.model_dir,
+            f"{CALIBRATION_FILE_PREFIX}-{self.model_class.__name__}-{self._get_features_name()}{CALIBRATION_FILE_EXT}"
         )
 
+    def get_model_files(self) -> list[str]:
+        current_dir_name = self.generations.current()
+        if current_dir_name is not None:
+            return ModelGenerations.get_files(current_dir_name)
+
+        data_dir = os.path.abspath(DATA_DIR)
+        mapped_dir_name = os.path.join(
+            data_dir, os.path.basename(self._get_mapped_model_dir_name())
+        )
+        file_names = [
+            os.path.join(data_dir, os.path.basename(file_name))
+            for file_name in (
+                self._get_model_file_name(),
+                self._get_vocabulary_file_name(),
+                self._get_vectorizer_state_file_name(),
+            )
+        ]
+        if os.path.isdir(mapped_dir_name):
+            file_names.extend(
+                os.path.join(mapped_dir_name, file_name)
+                for file_name in sorted(os.listdir(mapped_dir_name))
+            )
+        return [
+            file_name for file_name in file_names if os.path.isfile(file_name)
+        ]
+
+    def _get_mapped_model_dir_name(self) -> str:
+        return os.path.join(
+            self.model_dir,
+            f"{MODEL_FILE_PREFIX}-{self.model_class.__name__}-{self._get_features_name()}{MAPPED_MODEL_DIR_EXT}"
+        )
+
+    def _load_mapped_model(self) -> MappedModel | None:
+        dir_name = self._get_mapped_model_dir_name()
+        try:
+            if MappedModel.exists(dir_name):
+                return MappedModel.load(dir_name)
+        except:  # pylint: disable=bare-except
+            log(LOG_WARN, f"Mapping model from directory '{dir_name}' failed")
+        return None
+
     def _load_model(self) -> ModelType | None:
         file_name = self._get_model_file_name()
         try:
@@ -155,8 +358,60 @@ class SpamDetectorModelBayesBase(SpamDetectorModelBase, Generic[VectorizerType,
             log(LOG_WARN, f"Loading vocabulary from file '{file_name}' failed")
         return {}
 
+    def _get_stop_words_file_name(self) -> str:
+        return os.path.join(self.model_dir, STOP_WORDS_FILE_NAME)
+
+    def _load_stop_words(self) -> frozenset[str]:
+        """
+        Load the stop words the model was trained with
+
+        Models without stored stop words (and new ones) use the stop words
+        of STOP_WORD_LANGUANGES from nltk.
+        """
+        file_name = self._get_stop_words_file_name()
+        try:
+            if os.path.isfile(file_name):
+                with open(file_name, 'r', encoding='UTF-8') as file_handle:
+                    log(LOG_DEBUG, f"Loading stop words from file '{file_name}'")
+                    return frozenset(json.load(file_handle))
+        except (OSError, ValueError) as e:  # pylint: disable=invalid-name
+            log(LOG_WARN, f"Loading stop words from file '{file_name}' failed: {e}")
+
+        log(LOG_INFO, f"Using stop words of {', '.join(STOP_WORD_LANGUANGES)} from nltk")
+        return get_stop_words()
+
+    def _load_calibration(self) -> Calibration:
+        file_name = self._get_calibration_file_name()
+        try:
+            return Calibration.load(file_name)
+        except (OSError, ValueError, KeyError) as e:  # pylint: disable=invalid-name
+            log(LOG_WARN, f"Loading calibration from file '{file_name}' failed: {e}")
+        return Calibration()
+
+    def _load_vectorizer_state(self) -> tuple[int, np.ndarray]:
+        file_name = self._get_vectorizer_state_file_name()
+        try:
+            if os.path.isfile(file_name) and os.access(file_name, os.R_OK):
+                with open(file_name, 'rb') as file_handle:
+                    log(LOG_INFO,
+                        f"Loading vectorizer state from file '{file_name}'")
+                    state: dict[str, Any] = pickle.load(file_handle)
+                    log(LOG_DEBUG,
+                        f"Loading vectorizer state from file '{file_name}' done")
+                    return (
+                        int(state['document_count']),
+                        np.asarray(
+                            state['document_frequencies'], dtype=np.int64
+                        ),
+                    )
+
+        except:  # pylint: disable=bare-except
+            log(LOG_WARN,
+                f"Loading vectorizer state from file '{file_name}' failed")
+        return (0, np.zeros(0, dtype=np.int64))
+
     def save_model(self):
-        """Save vocabulary and model to a file
+        """Save vocabulary, vectorizer state and model as a new generation
 
         Args:
             vocabulary (dict[str, int]): vocabulary to save
@@ -165,70 +420,378 @@ class SpamDetectorModelBayesBase(SpamDetectorModelBase, Generic[VectorizerType,
         """
 
         with self.lock:
-            with open(self._get_vocabulary_file_name(), 'wb') as file_handle:
-                pickle.dump(self.vocabulary, file_handle)
-            with open(self._get_model_file_name(), 'wb') as file_handle:
-                pickle.dump(self.model, file_handle)
+            # nothing may have been learned, e.g. if there are no new mails
+            self._get_model_vectorizer()
+            self._calibrate()
+
+            # write a new generation and publish it when all files are written
+            model_dir = self.model_dir
+            self.model_dir = self.generations.create()
+            try:
+                self._save_vocabulary()
+                with open(self._get_stop_words_file_name(), 'w', encoding='UTF-8') as file_handle:
+                    json.dump(sorted(self.stop_words), file_handle, ensure_ascii=False)
+                with open(self._get_model_file_name(), 'wb') as file_handle:
+                    pickle.dump(self.model, file_handle)
+                self.calibration.save(self._get_calibration_file_name())
+                self._save_mapped_model()
+                self.model_dir = self.generations.publish(self.model_dir)
+            except BaseException:
+                self.generations.discard(self.model_dir)
+                self.model_dir = model_dir
+                raise
+            self.generation = os.path.basename(self.model_dir)
+
+    def _save_mapped_model(self):
+        """Save the model arrays to be memory mapped for predictions"""
+        if not hasattr(self.model, 'feature_log_prob_'):
+            return
+
+        MappedModel.save(
+            self._get_mapped_model_dir_name(),
+            classes=self.model.classes_,  # type:ignore
+            class_log_prior=self.model.class_log_prior_,  # type:ignore
+            feature_log_prob=self.model.feature_log_prob_,  # type:ignore
+            idf=(
+                self._get_idf()
+                if self.vectorizer_class is TfidfVectorizer
+                else None
+            ),
+            vocabulary=self.vocabulary,
+        )
+
+    def _save_vocabulary(self):
+        """Save vocabulary and vectorizer state to a file"""
+        with open(self._get_vocabulary_file_name(), 'wb') as file_handle:
+            pickle.dump(self.vocabulary, file_handle)
+        with open(self._get_vectorizer_state_file_name(), 'wb') as file_handle:
+            pickle.dump(
+                {
+                    'document_count': self.document_count,
+                    'document_frequencies': self._get_document_frequencies(
+                        len(self.vocabulary)
+                    ),
+                },
+                file_handle
+            )
+
+    @staticmethod
+    def _analyze_fields(analyze: Callable[[str], list[str]], content: MailContent) -> list[list[str]]:
+        """
+        Get the features of each field of a mail, prefixed by the field's
+        namespace with FEATURE_NAMESPACES
+        """
+        if not FEATURE_NAMESPACES:
+            return [analyze(field) for field in content]
+        return [
+            [namespace + feature for feature in analyze(field)] if namespace else analyze(field)
+            for namespace, field in zip(FIELD_NAMESPACES, content)
+        ]
 
     def get_features(  # type:ignore
             self, contents: list[MailContent], vectorizer: VectorizerType
     ):
+        """
+        Get the features of mails, the sum of the features of their fields
+
+        Each field is analyzed once and the features of all fields are counted
+        into one matrix. It is weighted and normalized per field like the
+        vectorizer does, before the fields of each mail are added up.
+        """
         if len(contents) == 0:
             return None
 
-        features = None
-        for i in range(len(contents[0])):
-            _features = vectorizer.fit_transform(  # type:ignore
-                [c[i] for c in contents]
+        analyze = vectorizer.build_analyzer()
+        n_fields = len(contents[0])
+        fields_features = [
+            features
+            for content in contents
+            for features in self._analyze_fields(analyze, content)
+        ]
+        features = self._weight_features(
+            self._count_features(fields_features, vectorizer), vectorizer
+        ).tocoo(copy=False)
+
+        return csr_matrix(
+            (features.data, (features.row // n_fields, features.col)),
+            shape=(len(contents), features.shape[1])
+        )
+
+    def _count_features(self, documents_features: list[list[str]], vectorizer: VectorizerType) -> csr_matrix:  # pylint: disable=unused-argument
+        """
+        Count the vocabulary's features of analyzed documents like
+        CountVectorizer.transform, using the memory mapped vocabulary if there
+        is one
+        """
+        mapped = self.mapped
+        if mapped is not None and mapped.has_vocabulary:
+            return mapped.count(documents_features)
+
+        vocabulary = self.vocabulary
+        indptr = np.zeros(len(documents_features) + 1, dtype=np.int64)
+        indices: list[int] = []
+        for row, features in enumerate(documents_features):
+            indices.extend(
+                index for feature in features
+                if (index := vocabulary.get(feature)) is not None
             )
-            if features is None:
-                features = _features  # type:ignore
-            else:
-                features += _features  # type:ignore
-        return features  # type:ignore
+            indptr[row + 1] = len(indices)
+
+        counts = csr_matrix(
+            (
+                np.ones(len(indices), dtype=np.float64),
+                np.asarray(indices, dtype=np.int64),
+                indptr,
+            ),
+            shape=(len(documents_features), len(vocabulary))
+        )
+        counts.sum_duplicates()
+        return counts
+
+    def _weight_features(self, features: csr_matrix, vectorizer: VectorizerType) -> csr_matrix:
+        """
+        Apply the IDF weights and the normalization of the vectorizer
+        """
+        if isinstance(vectorizer, TfidfVectorizer):
+            idf = (
+                self.mapped.idf
+                if self.mapped is not None and self.mapped.idf is not None
+                else vectorizer.idf_
+            )
+            features.data *= idf[features.indices]
+
+        norm = getattr(vectorizer, 'norm', None)
+        if norm is None:
+            return features
+        return normalize(features, norm=norm, copy=False)
+
+    def _get_joint_log_likelihood(
+            self, contents: list[MailContent], timings: dict[str, float] | None = None
+    ) -> tuple[np.ndarray, list[str]]:
+        """
+        Get the joint log likelihood of each class for each mail
+
+        The seconds spent in the stages 'vectorize' and 'predict' are added to
+        `timings` if given.
 
-    def extend_vocabulary(self, documents: Iterable[str]):
-        """Extend the vocabulary by documents' tokens
+        Returns:
+            tuple[np.ndarray, list[str]]: log likelihoods per mail and class, class labels
+        """
+        with self.lock:
+            if not self.initialized:
+                self.load_model()
+            mapped = self.mapped
+            vectorizer = self.vectorizer
+            model = self.model if mapped is None else None
+
+        log(LOG_DEBUG, "Getting features of %d mails.", len(contents))
+        start = time.perf_counter()
+        features = self.get_features(  # type:ignore
+            contents=contents,
+            vectorizer=vectorizer
+        )
+        vectorized = time.perf_counter()
+
+        if mapped is not None:
+            result = (
+                mapped.joint_log_likelihood(features),  # type:ignore
+                [str(c) for c in mapped.classes],
+            )
+        else:
+            result = (
+                model.predict_joint_log_proba(features),  # type:ignore
+                [str(c) for c in model.classes_],  # type:ignore
+            )
+
+        if timings is not None:
+            timings['vectorize'] = vectorized - start
+            timings['predict'] = time.perf_counter() - vectorized
+        return result
+
+    def extend_vocabulary(self, contents: Iterable[MailContent]):
+        """Extend the vocabulary by the features of mails and count the
+        documents each feature appears in, every field is a document
 
         Args:
-            documents (Iterable[str]): documents to parse
+            contents (Iterable[MailContent]): mails to parse
         """
 
         analyze = self.vectorizer.build_analyzer()  # type:ignore
 
         with self.lock:
-            for doc in documents:
-                for feature in analyze(doc):  # type: ignore
+            document_count = 0
+            feature_indices: list[int] = []
+            for features in (
+                fields_features
+                for content in contents
+                for fields_features in self._analyze_fields(analyze, content)
+            ):
+                document_count += 1
+                document_features: set[int] = set()
+                for feature in features:  # type: ignore
                     feature = str(feature).lower()  # type: ignore
                     if feature not in self.vocabulary:
                         self.vocabulary[feature] = len(
                             self.vocabulary)
+                    document_features.add(self.vocabulary[feature])
+                feature_indices.extend(document_features)
+
+            n_features = len(self.vocabulary)
+            self.document_frequencies = self._get_document_frequencies(
+                n_features
+            ) + np.bincount(
+                np.asarray(feature_indices, dtype=np.int64),
+                minlength=n_features
+            )
+            self.document_count += document_count
 
-    def predict_mail(self, content: MailContent) -> bool:
-        model, vectorizer = self._get_model_vectorizer()
-        log(LOG_DEBUG, "Getting features.")
-        features_predict = self.get_features(  # type:ignore
-            contents=[content],
-            vectorizer=vectorizer
-        )
+    def predict_mail(self, content: MailContent, timings: dict[str, float] | None = None) -> float:
+        return self.predict_proba_mails([content], timings)[0]
+
+    def predict_mails(self, contents: list[MailContent]) -> list[bool]:
+        """
+        Predict which mails are spam, the mails with a spam probability of at
+        least SPAM_THRESHOLD
+        """
+        if len(contents) == 0:
+            return []
 
         log(LOG_DEBUG, "Predicting...")
+        predictions = [
+            probability >= SPAM_THRESHOLD
+            for probability in self.predict_proba_mails(contents)
+        ]
+
+        log(LOG_DEBUG, f"Prediction finished: {predictions}")
+        return predictions
+
+    def predict_proba_mails(self, contents: list[MailContent], timings: dict[str, float] | None = None) -> list[float]:
+        """
+        Predict the calibrated probability of being spam for each mail
+
+        Args:
+            contents (list[MailContent]): mails to score
 
-        # prediction_values = model.predict_proba(features_predict)
-        predictions = model.predict(features_predict)  # type:ignore
+        Returns:
+            list[float]: spam probability per mail
+        """
+        if len(contents) == 0:
+            return []
 
-        log(LOG_DEBUG, f"Prediction finished: {predictions[0]}")
-        return bool(predictions[0] == 'spam')
+        log(LOG_DEBUG, "Predicting probabilities...")
+        probabilities = self.calibration.predict_proba(
+            self._get_log_odds(contents, timings)
+        )
+
+        return [float(p) for p in probabilities]
+
+    def _get_log_odds(self, contents: list[MailContent], timings: dict[str, float] | None = None) -> np.ndarray:
+        """
+        Get the log odds of the model for each mail being spam
+        """
+        joint_log_likelihood, classes = self._get_joint_log_likelihood(contents, timings)
+        spam_index = classes.index('spam')
+        return joint_log_likelihood[:, spam_index] - logsumexp(
+            np.delete(joint_log_likelihood, spam_index, axis=1), axis=1
+        )
 
     def learn_mails(self, contents: list[MailContent], labels: list[str]):
+        """
+        Learn a chunk of mails
+
+        Every CALIBRATION_HOLD_OUT-th mail is held out until the model is
+        saved, up to CALIBRATION_MAX_MAILS mails.
+        """
+        learn_contents: list[MailContent] = []
+        learn_labels: list[str] = []
         with self.lock:
-            self.extend_vocabulary(
-                documents=chain.from_iterable(contents),
-            )
+            for content, label in zip(contents, labels):
+                self.training_mails += 1
+                if self.training_mails % CALIBRATION_HOLD_OUT == 0 and len(self.held_out_contents) < CALIBRATION_MAX_MAILS:
+                    self.held_out_contents.append(content)
+                    self.held_out_labels.append(label)
+                else:
+                    learn_contents.append(content)
+                    learn_labels.append(label)
+
+            if learn_contents:
+                self._learn_mails(learn_contents, learn_labels)
+
+    def learn_vocabulary(self, contents: list[MailContent]):
+        with self.lock:
+            self._get_model_vectorizer()
+            self.extend_vocabulary(contents=contents)
+            self.vocabulary_learned = True
+
+    def _learn_mails(self, contents: list[MailContent], labels: list[str]):
+        with self.lock:
+            self._get_model_vectorizer()
+            if not self.vocabulary_learned:
+                self.extend_vocabulary(contents=contents)
+            # vocabulary and IDF weights may have changed, so refresh the fitted vectorizer
+            self.vectorizer = self._create_vectorizer()
 
             features = self.get_features(  # type:ignore
                 contents=contents,
                 vectorizer=self.vectorizer
             )
 
+            self._partial_fit(features, labels)  # type:ignore
+
+    def _calibrate(self):
+        """
+        Fit the calibration on the held out mails and learn them afterwards
+
+        The current calibration is kept if there are less than
+        CALIBRATION_MIN_MAILS held out mails of a label, e.g. in a run
+        learning a few new mails, or the model has not learned any other mails.
+        """
+        contents, labels = self.held_out_contents, self.held_out_labels
+        if not contents:
+            return
+        self.held_out_contents, self.held_out_labels = [], []
+
+        if hasattr(self.model, 'classes_') and all(labels.count(label) >= CALIBRATION_MIN_MAILS for label in LABELS):
+            self.calibration = Calibration.fit(
+                self._get_log_odds(contents),
+                np.array([label == 'spam' for label in labels])
+            )
+        else:
+            log(LOG_INFO, f"Not calibrating on {len(contents)} held out mails. Keeping the current calibration.")
+
+        self._learn_mails(contents, labels)
+
+    def _partial_fit(self, features, labels: list[str]):  # type:ignore
+        """
+        Update the model with a chunk of mails keeping what was learned before
+
+        Models without `partial_fit` are fitted on the chunk only.
+        """
+        if not hasattr(self.model, 'partial_fit'):
             self.model.fit(features, labels)  # type:ignore
+            return
+
+        self._widen_model(features.shape[1])  # type:ignore
+        self.model.partial_fit(  # type:ignore
+            features, labels, classes=LABELS
+        )
+
+    def _widen_model(self, n_features: int):
+        """
+        Add zero counts for features added to the vocabulary since the model
+        was last updated
+        """
+        feature_count = getattr(self.model, 'feature_count_', None)
+        if feature_count is None:
+            return
+
+        missing = n_features - feature_count.shape[1]
+        if missing <= 0:
+            return
+
+        log(LOG_DEBUG, f"Adding {missing} features to the model")
+        self.model.feature_count_ = np.hstack((  # type:ignore
+            feature_count,
+            np.zeros((feature_count.shape[0], missing), dtype=feature_count.dtype)
+        ))
+        self.model.n_features_in_ = n_features  # type:ignore
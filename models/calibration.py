@@ -0,0 +1,97 @@
+import json
+import os
+
+import numpy as np
+from scipy.optimize import minimize  # type: ignore
+from scipy.special import expit  # type: ignore
+
+from mail_logging import LOG_DEBUG, LOG_INFO
+from mail_logging.logging import log
+
+
+class Calibration:
+    """
+    Platt scaling of the spam log odds of a model
+
+    Naive bayes assumes the features to be independent, so its log odds grow
+    with the length of a mail and its probabilities are nearly always 0 or
+    1. The calibrated probability is `expit(slope * log_odds + intercept)`.
+    Without calibration (slope 1, intercept 0) it is the model's probability.
+    """
+
+    def __init__(self, slope: float = 1.0, intercept: float = 0.0, mails: int = 0) -> None:
+        self.slope = slope
+        self.intercept = intercept
+        # number of mails the calibration was fitted on
+        self.mails = mails
+
+    @classmethod
+    def fit(cls, log_odds: np.ndarray, is_spam: np.ndarray) -> 'Calibration':
+        """
+        Fit the scaling to the log odds of mails the model was not trained on
+
+        The targets are smoothed like Platt does, so mails the model
+        separates perfectly do not push the probabilities to 0 and 1 again.
+
+        Args:
+            log_odds (np.ndarray): spam log odds of the model per mail
+            is_spam (np.ndarray): True for each spam mail
+
+        Returns:
+            Calibration: the fitted calibration
+        """
+        n_spam = int(np.count_nonzero(is_spam))
+        n_ham = len(is_spam) - n_spam
+        targets = np.where(is_spam, (n_spam + 1) / (n_spam + 2), 1 / (n_ham + 2))
+        # the log odds of naive bayes are large, scaling them helps the optimizer
+        scale = max(float(np.std(log_odds)), 1.0)
+        values = np.asarray(log_odds, dtype=np.float64) / scale
+
+        def loss(params: np.ndarray) -> tuple[float, np.ndarray]:
+            z = params[0] * values + params[1]
+            errors = expit(z) - targets
+            return (
+                float(np.sum(np.logaddexp(0, z) - targets * z)),
+                np.array([np.dot(errors, values), np.sum(errors)]),
+            )
+
+        result = minimize(loss, np.array([1.0, 0.0]), jac=True, method='L-BFGS-B')
+        calibration = cls(
+            slope=float(result.x[0]) / scale,
+            intercept=float(result.x[1]),
+            mails=len(is_spam),
+        )
+        log(
+            LOG_INFO,
+            "Calibrated probabilities on %d mails: slope %.4g, intercept %.4g",
+            calibration.mails, calibration.slope, calibration.intercept
+        )
+        return calibration
+
+    def predict_proba(self, log_odds: np.ndarray) -> np.ndarray:
+        return expit(self.slope * log_odds + self.intercept)
+
+    @classmethod
+    def load(cls, file_name: str) -> 'Calibration':
+        """
+        Load a calibration, models saved without one are not calibrated
+        """
+        if not os.path.isfile(file_name):
+            return cls()
+
+        log(LOG_DEBUG, f"Loading calibration from file '{file_name}'")
+        with open(file_name, 'r', encoding='UTF-8') as file_handle:
+            data = json.load(file_handle)
+        return cls(
+            slope=float(data['slope']),
+            intercept=float(data['intercept']),
+            mails=int(data['mails']),
+        )
+
+    def save(self, file_name: str) -> None:
+        with open(file_name, 'w', encoding='UTF-8') as file_handle:
+            json.dump(
+                {'slope': self.slope, 'intercept': self.intercept, 'mails': self.mails},
+                file_handle,
+                indent=2,
+            )
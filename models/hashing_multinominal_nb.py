@@ -0,0 +1,68 @@
+from sqlite3 import OperationalError
+from typing import Iterable
+
+from scipy.sparse import csr_matrix  # type: ignore
+from sklearn.feature_extraction import FeatureHasher  # type: ignore
+from sklearn.feature_extraction.text import HashingVectorizer  # type: ignore
+from sklearn.naive_bayes import MultinomialNB  # type: ignore
+
+from constants import HASHING_N_FEATURES, N_GRAMS
+from mail_types import MailContent
+from models.bayes_base import STRIP_ACCENTS, SpamDetectorModelBayesBase
+
+
+class SpamDetectorModelHashingMultinominal(SpamDetectorModelBayesBase[HashingVectorizer, MultinomialNB]):
+    """
+    Multinominal naive bayes on hashed tokens
+
+    Tokens are mapped into HASHING_N_FEATURES features by their hash, so
+    there is no vocabulary to store, load or lock.
+    """
+
+    def __init__(self, for_training: bool = False) -> None:
+        super().__init__(
+            vectorizer_class=HashingVectorizer,
+            model_class=MultinomialNB,
+            for_training=for_training
+        )
+
+    def _create_vectorizer(self) -> HashingVectorizer:
+        return HashingVectorizer(
+            n_features=HASHING_N_FEATURES,
+            # naive bayes needs non negative features
+            alternate_sign=False,
+            ngram_range=N_GRAMS,
+            strip_accents=STRIP_ACCENTS,
+            decode_error='ignore',
+            stop_words=sorted(self.stop_words),
+        )
+
+    def _get_vectorizer_name(self) -> str:
+        return f"{self.vectorizer_class.__name__}{HASHING_N_FEATURES}"
+
+    def _get_vocabulary_model(self, train: bool = False) -> tuple[dict[str, int], MultinomialNB]:
+        model = self._load_model()
+        if model is None:
+            if train:
+                return ({}, self.model_class())
+            raise OperationalError("Could not load model")
+
+        return ({}, model)
+
+    def _load_vocabulary(self) -> dict[str, int]:
+        return {}
+
+    def _save_vocabulary(self):
+        pass
+
+    def _count_features(self, documents_features: list[list[str]], vectorizer: HashingVectorizer) -> csr_matrix:
+        # like HashingVectorizer.transform without analyzing again
+        return FeatureHasher(
+            n_features=vectorizer.n_features,
+            input_type='string',
+            dtype=vectorizer.dtype,
+            alternate_sign=vectorizer.alternate_sign,
+        ).transform(documents_features)
+
+    def extend_vocabulary(self, contents: Iterable[MailContent]):
+        pass
@@ -0,0 +1,194 @@
+import hashlib
+import os
+from itertools import chain
+
+import numpy as np
+from scipy.sparse import csr_matrix  # type: ignore
+
+from mail_logging import LOG_DEBUG, LOG_INFO, LOG_WARN
+from mail_logging.logging import log
+
+_CLASSES_FILE = 'classes.npy'
+_CLASS_LOG_PRIOR_FILE = 'class_log_prior.npy'
+# log probabilities of the features per class, as (n_features, n_classes)
+_FEATURE_WEIGHTS_FILE = 'feature_weights.npy'
+# (n_classes, n_features) log probabilities of models saved by older versions
+_FEATURE_LOG_PROB_FILE = 'feature_log_prob.npy'
+_IDF_FILE = 'idf.npy'
+_VOCABULARY_HASHES_FILE = 'vocabulary_hashes.npy'
+_VOCABULARY_INDICES_FILE = 'vocabulary_indices.npy'
+
+
+def hash_features(features: list[str]) -> np.ndarray:
+    """
+    Get stable 64 bit hashes of features
+    """
+    return np.frombuffer(
+        b''.join(
+            hashlib.blake2b(
+                feature.encode('utf-8', errors='surrogatepass'), digest_size=8
+            ).digest()
+            for feature in features
+        ),
+        dtype='<u8'
+    )
+
+
+def _load(directory: str, file_name: str) -> np.ndarray | None:
+    file_path = os.path.join(directory, file_name)
+    if not os.path.isfile(file_path):
+        return None
+    return np.load(file_path, mmap_mode='r', allow_pickle=False)
+
+
+class MappedModel:
+    """
+    Naive bayes model arrays and vocabulary stored as raw NumPy files
+
+    The files are memory mapped, so loading is nearly instant and processes
+    using the same model share its pages through the page cache. The
+    vocabulary is stored as sorted 64 bit hashes of the features with the
+    feature index of each hash.
+
+    The feature log probabilities are stored transposed and C contiguous,
+    so multiplying the sparse features with them uses the mapped pages
+    instead of copying the matrix for every prediction.
+    """
+
+    def __init__(
+        self,
+        classes: np.ndarray,
+        class_log_prior: np.ndarray,
+        feature_weights: np.ndarray,
+        idf: np.ndarray | None = None,
+        vocabulary_hashes: np.ndarray | None = None,
+        vocabulary_indices: np.ndarray | None = None,
+    ) -> None:
+        self.classes = classes
+        self.class_log_prior = class_log_prior
+        # feature log probabilities as (n_features, n_classes)
+        self.feature_weights = feature_weights
+        self.idf = idf
+        self.vocabulary_hashes = vocabulary_hashes
+        self.vocabulary_indices = vocabulary_indices
+
+    @property
+    def n_features(self) -> int:
+        return self.feature_weights.shape[0]
+
+    @property
+    def has_vocabulary(self) -> bool:
+        return self.vocabulary_hashes is not None
+
+    @staticmethod
+    def exists(directory: str) -> bool:
+        return any(
+            os.path.isfile(os.path.join(directory, file_name))
+            for file_name in (_FEATURE_WEIGHTS_FILE, _FEATURE_LOG_PROB_FILE)
+        )
+
+    @classmethod
+    def load(cls, directory: str) -> 'MappedModel':
+        log(LOG_INFO, f"Mapping model from directory '{directory}'")
+        classes = _load(directory, _CLASSES_FILE)
+        class_log_prior = _load(directory, _CLASS_LOG_PRIOR_FILE)
+        feature_weights = _load(directory, _FEATURE_WEIGHTS_FILE)
+        if feature_weights is None:
+            feature_log_prob = _load(directory, _FEATURE_LOG_PROB_FILE)
+            if feature_log_prob is not None:
+                log(LOG_WARN, f"Copying the feature log probabilities of the old model in '{directory}'")
+                feature_weights = np.ascontiguousarray(feature_log_prob.T)
+        if classes is None or class_log_prior is None or feature_weights is None:
+            raise FileNotFoundError(f"Incomplete model in '{directory}'")
+
+        return cls(
+            classes=np.asarray(classes),
+            class_log_prior=class_log_prior,
+            feature_weights=feature_weights,
+            idf=_load(directory, _IDF_FILE),
+            vocabulary_hashes=_load(directory, _VOCABULARY_HASHES_FILE),
+            vocabulary_indices=_load(directory, _VOCABULARY_INDICES_FILE),
+        )
+
+    @staticmethod
+    def save(
+        directory: str,
+        classes: np.ndarray,
+        class_log_prior: np.ndarray,
+        feature_log_prob: np.ndarray,
+        idf: np.ndarray | None = None,
+        vocabulary: dict[str, int] | None = None,
+    ) -> None:
+        log(LOG_INFO, f"Saving mapped model to directory '{directory}'")
+        os.makedirs(directory, exist_ok=True)
+
+        arrays: dict[str, np.ndarray] = {
+            _CLASSES_FILE: np.asarray(classes, dtype=str),
+            _CLASS_LOG_PRIOR_FILE: np.asarray(class_log_prior, dtype=np.float64),
+            _FEATURE_WEIGHTS_FILE: np.ascontiguousarray(
+                np.asarray(feature_log_prob, dtype=np.float64).T
+            ),
+        }
+        if idf is not None:
+            arrays[_IDF_FILE] = np.asarray(idf, dtype=np.float64)
+
+        if vocabulary:
+            hashes = hash_features(list(vocabulary.keys()))
+            indices = np.fromiter(
+                vocabulary.values(), dtype=np.int64, count=len(vocabulary)
+            )
+            order = np.argsort(hashes, kind='stable')
+            hashes = hashes[order]
+            indices = indices[order]
+
+            duplicates = np.flatnonzero(hashes[1:] == hashes[:-1]) + 1
+            if len(duplicates) > 0:
+                log(LOG_WARN, f"Dropping {len(duplicates)} features with colliding hashes")
+                hashes = np.delete(hashes, duplicates)
+                indices = np.delete(indices, duplicates)
+
+            arrays[_VOCABULARY_HASHES_FILE] = hashes
+            arrays[_VOCABULARY_INDICES_FILE] = indices
+
+        for file_name, array in arrays.items():
+            np.save(os.path.join(directory, file_name), array, allow_pickle=False)
+
+        for file_name in (_FEATURE_LOG_PROB_FILE, _IDF_FILE, _VOCABULARY_HASHES_FILE, _VOCABULARY_INDICES_FILE):
+            file_path = os.path.join(directory, file_name)
+            if file_name not in arrays and os.path.isfile(file_path):
+                os.unlink(file_path)
+
+        log(LOG_DEBUG, f"Saving mapped model to directory '{directory}' done")
+
+    def count(self, documents_features: list[list[str]]) -> csr_matrix:
+        """
+        Count the vocabulary's features of analyzed documents like
+        CountVectorizer.transform
+
+        The features of all documents are looked up at once.
+        """
+        assert self.vocabulary_hashes is not None and self.vocabulary_indices is not None
+
+        lengths = np.fromiter(
+            (len(features) for features in documents_features),
+            dtype=np.int64, count=len(documents_features)
+        )
+        rows = np.repeat(np.arange(len(documents_features)), lengths)
+        hashes = hash_features(list(chain.from_iterable(documents_features)))
+        positions = np.searchsorted(self.vocabulary_hashes, hashes)
+        positions[positions >= len(self.vocabulary_hashes)] = 0
+        found = self.vocabulary_hashes[positions] == hashes
+
+        # duplicates are summed up
+        return csr_matrix(
+            (
+                np.ones(np.count_nonzero(found), dtype=np.float64),
+                (rows[found], self.vocabulary_indices[positions[found]]),
+            ),
+            shape=(len(documents_features), self.n_features)
+        )
+
+    def joint_log_likelihood(self, features: csr_matrix) -> np.ndarray:
+        return np.asarray(
+            features @ self.feature_weights + self.class_log_prior
+        )
@@ -5,6 +5,10 @@ from models.bayes_base import SpamDetectorModelBayesBase
 
 
 class SpamDetectorModelTfidMultinominal(SpamDetectorModelBayesBase[TfidfVectorizer, MultinomialNB]):
+    # the learned feature counts are weighted with the IDF of the time they
+    # were learned, the predictions with the final one
+    incremental = False
+
     def __init__(self, for_training: bool = False) -> None:
         super().__init__(
             vectorizer_class=TfidfVectorizer,
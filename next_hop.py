@@ -0,0 +1,340 @@
+"""
+Asynchronous SMTP client delivering mails to the next hop over pooled connections
+"""
+
+import asyncio
+import os
+import re
+import smtplib
+import socket
+from collections import deque
+
+from constants import NEXT_PEER_PORT_DEFAULT
+from mail_logging import LOG_DEBUG, LOG_ERROR, LOG_INFO
+from mail_logging.logging import log
+
+CRLF = b'\r\n'
+
+_RE_LINE_ENDINGS = re.compile(br'\r\n|\r|\n')
+_RE_LEADING_PERIOD = re.compile(br'(?m)^\.')
+
+
+def _encode_address(address: str) -> bytes:
+    return smtplib.quoteaddr(address).encode('utf-8')
+
+
+def _prepare_data(data: bytes) -> bytes:
+    """
+    Normalize line endings, quote leading periods and append the end of data mark
+    """
+    # Only copy the mail if it needs to be changed
+    crlf_count = data.count(CRLF)
+    if data.count(b'\n') != crlf_count or data.count(b'\r') != crlf_count:
+        data = _RE_LINE_ENDINGS.sub(CRLF, data)
+    if data.startswith(b'.') or b'\n.' in data:
+        data = _RE_LEADING_PERIOD.sub(b'..', data)
+    if not data.endswith(CRLF):
+        data += CRLF
+    return data + b'.' + CRLF
+
+
+class _NextHopConnection:
+    """
+    A single SMTP connection to the next hop
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, timeout: float) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.features: set[str] = set()
+        self.messages_sent = 0
+        self.last_used = 0.0
+        self.needs_reset = False
+        self.data_started = False
+
+    @property
+    def pipelining(self) -> bool:
+        return 'pipelining' in self.features
+
+    def is_closing(self) -> bool:
+        return self.writer.is_closing() or self.reader.at_eof()
+
+    async def read_reply(self) -> tuple[int, bytes]:
+        """
+        Read a (multi line) reply
+
+        Returns:
+            tuple[int, bytes]: reply code and message
+        """
+        lines: list[bytes] = []
+        while True:
+            line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+            if not line:
+                raise smtplib.SMTPServerDisconnected(
+                    "Connection unexpectedly closed"
+                )
+            lines.append(line[4:].strip())
+            if line[3:4] != b'-':
+                try:
+                    code = int(line[:3])
+                except ValueError:
+                    code = -1
+                return (code, b'\n'.join(lines))
+
+    async def command(self, *lines: bytes) -> list[tuple[int, bytes]]:
+        """
+        Send commands at once and read a reply for each of them
+        """
+        self.writer.write(b''.join(line + CRLF for line in lines))
+        await asyncio.wait_for(self.writer.drain(), self.timeout)
+        return [await self.read_reply() for _ in lines]
+
+    async def hello(self, local_hostname: str) -> None:
+        code, message = await self.read_reply()
+        if code != 220:
+            raise smtplib.SMTPConnectError(code, message)
+
+        [(code, message)] = await self.command(
+            b'EHLO ' + local_hostname.encode('ascii')
+        )
+        if code == 250:
+            self.features = {
+                line.split(maxsplit=1)[0].decode('ascii', errors='ignore').lower()
+                for line in message.splitlines()[1:]
+                if line
+            }
+            return
+
+        [(code, message)] = await self.command(
+            b'HELO ' + local_hostname.encode('ascii')
+        )
+        if code != 250:
+            raise smtplib.SMTPHeloError(code, message)
+
+    async def send(self, mail_from: str, rcpt_tos: list[str], data: bytes) -> dict[str, tuple[int, bytes]]:
+        """
+        Send a mail, pipelining MAIL, RCPT and DATA if the server supports it
+
+        Returns:
+            dict[str, tuple[int, bytes]]: refused recipients
+        """
+        if self.needs_reset:
+            [(code, message)] = await self.command(b'RSET')
+            if code != 250:
+                raise smtplib.SMTPResponseException(code, message)
+            self.needs_reset = False
+
+        # Reset after everything not ending with an accepted mail
+        self.needs_reset = True
+        self.data_started = False
+        commands = [b'MAIL FROM:' + _encode_address(mail_from)] + [
+            b'RCPT TO:' + _encode_address(rcpt) for rcpt in rcpt_tos
+        ]
+
+        if self.pipelining:
+            replies = await self.command(*commands, b'DATA')
+        else:
+            replies = await self.command(commands[0])
+            if replies[0][0] == 250:
+                for command in commands[1:]:
+                    replies += await self.command(command)
+                if any(code in (250, 251) for code, _ in replies[1:]):
+                    replies += await self.command(b'DATA')
+
+        (code, message) = replies[0]
+        if code != 250:
+            raise smtplib.SMTPSenderRefused(code, message, mail_from)
+
+        refused: dict[str, tuple[int, bytes]] = {
+            rcpt: reply
+            for rcpt, reply in zip(rcpt_tos, replies[1:len(rcpt_tos) + 1])
+            if reply[0] not in (250, 251)
+        }
+
+        data_reply = replies[len(rcpt_tos) + 1] if len(replies) > len(rcpt_tos) + 1 else None
+        if len(refused) == len(rcpt_tos):
+            if data_reply is not None and data_reply[0] == 354:
+                # The server accepted DATA anyway. Ending it could deliver an
+                # empty mail, so drop the connection to abort the transaction
+                self.writer.close()
+            raise smtplib.SMTPRecipientsRefused(refused)  # type:ignore
+
+        assert data_reply is not None
+        (code, message) = data_reply
+        if code != 354:
+            raise smtplib.SMTPDataError(code, message)
+
+        self.data_started = True
+        self.writer.write(_prepare_data(data))
+        await asyncio.wait_for(self.writer.drain(), self.timeout)
+        (code, message) = await self.read_reply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, message)
+
+        self.needs_reset = False
+        self.messages_sent += 1
+        return refused
+
+    async def close(self) -> None:
+        try:
+            if not self.is_closing():
+                await self.command(b'QUIT')
+        except (OSError, asyncio.TimeoutError, smtplib.SMTPException):
+            pass
+        finally:
+            self.writer.close()
+
+
+class NextHopPool:
+    """
+    Pool of persistent SMTP connections to the next hop
+
+    `next_peer` is a unix socket if it contains a slash, else a hostname with
+    an optional port separated by a colon.
+    """
+
+    def __init__(
+        self,
+        next_peer: str,
+        max_connections: int,
+        idle_timeout: float,
+        max_messages: int,
+        timeout: float,
+    ) -> None:
+        self.next_peer = next_peer
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.max_messages = max_messages
+        self.timeout = timeout
+        self.local_hostname = socket.getfqdn()
+        self._idle: deque[_NextHopConnection] = deque()
+        self._semaphore = asyncio.Semaphore(max_connections)
+        # connections being closed in the background
+        self._closing: set[asyncio.Task] = set()
+
+    async def _connect(self) -> _NextHopConnection:
+        if self.next_peer.find('/') >= 0:
+            log(LOG_DEBUG, "Connecting to next hop via unix:%s", self.next_peer)
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_unix_connection(os.path.abspath(self.next_peer)),
+                self.timeout
+            )
+        else:
+            socket_data = self.next_peer.split(sep=':', maxsplit=1)
+            hostname: str = socket_data[0]
+            port: int = (
+                int(socket_data[1])
+                if len(socket_data) > 1
+                else NEXT_PEER_PORT_DEFAULT
+            )
+            log(LOG_DEBUG, "Connecting to next hop via smtp:%s:%s", hostname, port)
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(hostname, port),
+                self.timeout
+            )
+
+        connection = _NextHopConnection(reader, writer, self.timeout)
+        try:
+            await connection.hello(self.local_hostname)
+        except (OSError, asyncio.TimeoutError, smtplib.SMTPException):
+            writer.close()
+            raise
+        return connection
+
+    def _close_later(self, connection: _NextHopConnection) -> None:
+        # keep a reference, the loop only keeps weak ones to its tasks
+        task = asyncio.create_task(connection.close())
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    def _get_idle_connection(self) -> _NextHopConnection | None:
+        now = asyncio.get_running_loop().time()
+        while self._idle:
+            connection = self._idle.pop()
+            if not connection.is_closing() and now - connection.last_used < self.idle_timeout:
+                return connection
+            self._close_later(connection)
+        return None
+
+    def _release(self, connection: _NextHopConnection) -> None:
+        if connection.is_closing() or connection.messages_sent >= self.max_messages:
+            self._close_later(connection)
+            return
+
+        loop = asyncio.get_running_loop()
+        connection.last_used = loop.time()
+        self._idle.append(connection)
+        loop.call_later(self.idle_timeout, self._close_idle)
+
+    def _close_idle(self) -> None:
+        now = asyncio.get_running_loop().time()
+        while self._idle and now - self._idle[0].last_used >= self.idle_timeout:
+            self._close_later(self._idle.popleft())
+
+    async def _send(self, mail_from: str, rcpt_tos: list[str], data: bytes) -> dict[str, tuple[int, bytes]]:
+        connection = self._get_idle_connection()
+        if connection is not None:
+            try:
+                refused = await connection.send(mail_from, rcpt_tos, data)
+                self._release(connection)
+                return refused
+            except (OSError, asyncio.TimeoutError, smtplib.SMTPServerDisconnected) as e:  # pylint:disable=invalid-name
+                connection.writer.close()
+                if connection.data_started:
+                    raise
+                # The server may have closed the idle connection. The mail has
+                # not been sent yet, so try again on a new connection.
+                log(LOG_DEBUG, "Pooled connection to next hop failed: %s", e)
+            except smtplib.SMTPException:
+                self._release(connection)
+                raise
+
+        connection = await self._connect()
+        try:
+            refused = await connection.send(mail_from, rcpt_tos, data)
+        except (OSError, asyncio.TimeoutError, smtplib.SMTPServerDisconnected):
+            connection.writer.close()
+            raise
+        except smtplib.SMTPException:
+            self._release(connection)
+            raise
+        self._release(connection)
+        return refused
+
+    async def deliver(self, mail_from: str, rcpt_tos: list[str], data: bytes) -> dict[str, tuple[int, bytes]]:
+        """
+        Deliver a mail to the next hop
+
+        Returns:
+            dict[str, tuple[int, bytes]]: refused recipients with error code and message
+        """
+        refused: dict[str, tuple[int, bytes]] = {}
+        try:
+            async with self._semaphore:
+                refused = await self._send(mail_from, rcpt_tos, data)
+            log(LOG_DEBUG, "Refused error: %s", refused)
+        except smtplib.SMTPRecipientsRefused as e:  # pylint:disable=invalid-name
+            refused = e.recipients
+            log(LOG_ERROR, "SMTPRecipientsRefused: %s", e)
+        except (OSError, asyncio.TimeoutError, smtplib.SMTPException) as e:  # pylint:disable=invalid-name
+            log(LOG_ERROR, "SMTPException: %s", e)
+            # All recipients were refused.  If the exception had an associated
+            # error code, use it.  Otherwise, fake it with a non-triggering
+            # exception code.
+            errcode = getattr(e, "smtp_code", -1)
+            errmsg = getattr(e, "smtp_error", b"ignore")
+            for r in rcpt_tos:
+                refused[str(r)] = (errcode, errmsg)
+
+        return refused
+
+    async def close(self) -> None:
+        log(LOG_INFO, f"Closing {len(self._idle)} connections to next hop")
+        while self._idle:
+            await self._idle.pop().close()
+        # closing the sockets of connections still saying QUIT is enough
+        tasks = list(self._closing)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,70 @@
+"""
+Cache of classification results of recently seen mails
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Generic, TypeVar
+
+from mail_types import MailContent
+
+ValueType = TypeVar('ValueType')
+
+
+def get_content_key(content: MailContent, generation: str | None) -> str:
+    """
+    Get a cache key of a mail's content and the model generation
+
+    Case and whitespace are not relevant to the vectorizer, so mails only
+    differing in these get the same key.
+    """
+    content_hash = hashlib.blake2b(digest_size=16)
+    for field in content:
+        content_hash.update(' '.join(field.lower().split()).encode('utf-8', errors='surrogatepass'))
+        content_hash.update(b'\0')
+    return f"{generation or ''}:{content_hash.hexdigest()}"
+
+
+class ResultCache(Generic[ValueType]):
+    """
+    Threadsafe LRU cache with entries expiring after `ttl` seconds
+    """
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[float, ValueType]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> ValueType | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, value: ValueType) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
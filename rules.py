@@ -0,0 +1,119 @@
+"""
+Rule sets of regular expressions from the config compiled into one expression each
+"""
+
+import re
+from functools import lru_cache
+from typing import Generic, Iterable, TypeVar
+
+ValueType = TypeVar('ValueType')
+
+# Flags that can be applied to a part of an expression
+_SCOPED_FLAGS: dict[re.RegexFlag, str] = {
+    re.IGNORECASE: 'i',
+    re.MULTILINE: 'm',
+    re.DOTALL: 's',
+    re.VERBOSE: 'x',
+    re.ASCII: 'a',
+    re.UNICODE: 'u',
+}
+
+_NEVER_MATCHES = r'(?!)'
+
+
+def _scope_flags(pattern: str, flags: re.RegexFlag | int) -> str:
+    letters = ''
+    for flag, letter in _SCOPED_FLAGS.items():
+        if flags & flag:
+            letters += letter
+            flags &= ~flag
+    if flags:
+        raise ValueError(f"Unsupported flags {flags!r} for expression '{pattern}'")
+    if not letters:
+        return f"(?:{pattern})"
+    # line break for a trailing comment in verbose expressions
+    return f"(?{letters}:{pattern}\n)" if 'x' in letters else f"(?{letters}:{pattern})"
+
+
+class CompiledRules(Generic[ValueType]):
+    """
+    Rules combined into one alternation of named groups
+
+    The first rule matching at a position wins. Rules must not use numbered
+    back references as the groups of all rules share one numbering.
+    """
+
+    def __init__(self, rules: Iterable[tuple[str, re.RegexFlag | int, ValueType]]) -> None:
+        rules = list(rules)
+        self.values: list[ValueType] = [value for _, _, value in rules]
+        self.pattern = re.compile(
+            '|'.join(
+                f"(?P<_r{n}>{_scope_flags(pattern, flags)})"
+                for n, (pattern, flags, _) in enumerate(rules)
+            ) or _NEVER_MATCHES
+        )
+        # the group of the rule is closed last, so it is the match's lastindex
+        self._rule_of_group: dict[int, int] = {
+            self.pattern.groupindex[f"_r{n}"]: n for n in range(len(rules))
+        }
+
+    def _get_value(self, match: re.Match[str] | None) -> ValueType | None:
+        if match is None or match.lastindex is None:
+            return None
+        return self.values[self._rule_of_group[match.lastindex]]
+
+    def match(self, string: str) -> ValueType | None:
+        """
+        Get the value of the first rule matching at the beginning of string
+        """
+        return self._get_value(self.pattern.match(string))
+
+    def search(self, string: str) -> ValueType | None:
+        """
+        Get the value of the first rule matching anywhere in string
+        """
+        return self._get_value(self.pattern.search(string))
+
+    def remove(self, string: str) -> str:
+        """
+        Remove all matches of any rule
+
+        Removing is repeated until nothing matches, so rules anchored at the
+        beginning also remove what another rule's removal moved there.
+        """
+        while True:
+            removed = self.pattern.sub('', string)
+            # rules may match empty strings
+            if removed == string:
+                return removed
+            string = removed
+
+
+def compile_patterns(patterns: Iterable[tuple[str, re.RegexFlag | int]]) -> CompiledRules[bool]:
+    """
+    Compile patterns with their flags into one expression
+    """
+    return CompiledRules(
+        (pattern, flags, True) for pattern, flags in patterns
+    )
+
+
+class RecipientFilter:
+    """
+    Decides if a recipient gets its mails checked
+
+    The last rule matching the beginning of the address wins, the default is
+    True. Rules are tried in reverse order in one expression and decisions
+    are cached.
+    """
+
+    def __init__(self, rules: Iterable[tuple[str, bool]], cache_size: int = 4096) -> None:
+        self.rules: CompiledRules[bool] = CompiledRules(
+            (pattern, re.IGNORECASE, value)
+            for pattern, value in reversed(list(rules))
+        )
+        self.applies = lru_cache(maxsize=cache_size)(self._applies)
+
+    def _applies(self, recipient: str) -> bool:
+        value = self.rules.match(recipient)
+        return True if value is None else value
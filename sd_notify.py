@@ -0,0 +1,37 @@
+"""
+Notify systemd about the state of the daemon in units of Type=notify
+"""
+
+import os
+import socket
+
+from mail_logging import LOG_WARN
+from mail_logging.logging import log
+
+
+def notify(*states: str) -> bool:
+    """
+    Send states like 'READY=1' to the socket in NOTIFY_SOCKET
+
+    Args:
+        *states (str): assignments as described in sd_notify(3)
+
+    Returns:
+        bool: True if the states were sent, False if not started by systemd
+            or sending failed
+    """
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return False
+    if address.startswith('@'):
+        # abstract namespace
+        address = '\0' + address[1:]
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(address)
+            sock.sendall('\n'.join(states).encode('utf-8'))
+    except OSError as e:  # pylint: disable=invalid-name
+        log(LOG_WARN, "Notifying systemd failed: %s", e)
+        return False
+    return True
@@ -1,25 +1,49 @@
 import itertools
-import os
 import re
 import smtplib
 import socket
+import time
 from email import policy
+from email.header import Header
 from email.parser import BytesParser
-from functools import reduce
 from sqlite3 import OperationalError
-from typing import AnyStr
 
 from aiosmtpd.handlers import CRLF, EMPTYBYTES, NLCRE
 from aiosmtpd.smtp import SMTP, Envelope, Session
 
-from ai_filter_daemon import AIFilterDaemon
+import config
+import metrics
+from ai_filter_executor import AIFilterExecutor
 from config import (MAIL_HEADER_FIELD_PREFIX, RE_RECIPIENTS_FILTER,
                     SUBJECT_PREFIX)
-from constants import NEXT_PEER_PORT_DEFAULT, SMTP_ERROR_CODE_554
-from mail_logging import LOG_DEBUG, LOG_ERROR, LOG_INFO
-from mail_logging.logging import log
+from constants import (FORWARD_HEADER_SPLICE_DEFAULT,
+                       NEXT_PEER_IDLE_TIMEOUT_DEFAULT,
+                       NEXT_PEER_MAX_CONNECTIONS_DEFAULT,
+                       NEXT_PEER_MAX_MESSAGES_DEFAULT,
+                       NEXT_PEER_TIMEOUT_DEFAULT, SMTP_ERROR_CODE_451,
+                       SMTP_ERROR_CODE_554)
+from mail_logging import LOG_DEBUG, LOG_ERROR, LOG_INFO, LOG_WARN
+from mail_logging.logging import is_log_enabled, log
+from next_hop import NextHopPool
+from rules import RecipientFilter
 from tools import convert_message
 
+# settings missing in configurations written before they were added
+FORWARD_HEADER_SPLICE: bool = getattr(config, 'FORWARD_HEADER_SPLICE', FORWARD_HEADER_SPLICE_DEFAULT)
+NEXT_PEER_IDLE_TIMEOUT: float = getattr(config, 'NEXT_PEER_IDLE_TIMEOUT', NEXT_PEER_IDLE_TIMEOUT_DEFAULT)
+NEXT_PEER_MAX_CONNECTIONS: int = getattr(config, 'NEXT_PEER_MAX_CONNECTIONS', NEXT_PEER_MAX_CONNECTIONS_DEFAULT)
+NEXT_PEER_MAX_MESSAGES: int = getattr(config, 'NEXT_PEER_MAX_MESSAGES', NEXT_PEER_MAX_MESSAGES_DEFAULT)
+NEXT_PEER_TIMEOUT: float = getattr(config, 'NEXT_PEER_TIMEOUT', NEXT_PEER_TIMEOUT_DEFAULT)
+
+# End of the header block: the line ending of the last header field
+# followed by an empty line
+_RE_HEADER_END = re.compile(br'(\r?\n)\r?\n')
+# The empty group matches if the subject is empty, i.e. the line is not
+# folded and ends after the name
+_RE_SUBJECT = re.compile(br'(?im)^subject:[ \t]*((?=\r?\n(?![ \t])|\Z))?')
+
+_recipient_filter = RecipientFilter(RE_RECIPIENTS_FILTER)
+
 # Create a custom SMTP class by subclassing smtplib.SMTP
 
 
@@ -34,17 +58,84 @@ class UnixSocketSMTP(smtplib.SMTP):
         return s
 
 
+def _encode_header_value(value: str) -> bytes:
+    try:
+        return value.encode('ascii')
+    except UnicodeEncodeError:
+        return Header(value, 'utf-8').encode().encode('ascii')
+
+
+def splice_header_fields(
+    content: bytes, header_fields: list[tuple[bytes, bytes]], subject_prefix: str | None = None
+) -> bytes:
+    """
+    Add header fields and prefix the subject without parsing the mail
+
+    Only the header block is scanned, the body is passed on untouched.
+
+    Args:
+        content (bytes): the original mail
+        header_fields (list[tuple[bytes, bytes]]): names and values of header fields to add
+        subject_prefix (str | None, optional): prefix for the subject. Defaults to None.
+
+    Returns:
+        bytes: the modified mail
+    """
+    if match := NLCRE.match(content):
+        # no header fields at all
+        header_end = 0
+        ending = match[0]
+    elif match := _RE_HEADER_END.search(content):
+        header_end = match.end(1)
+        ending = match[1]
+    else:
+        # no body, only header fields
+        line_ending = NLCRE.search(content)
+        ending = line_ending[0] if line_ending else CRLF
+        if content and not content.endswith((b'\r\n', b'\n')):
+            content += ending
+        # the new fields start after the ending of the last field
+        header_end = len(content)
+
+    header = content[:header_end]
+    header_fields = list(header_fields)
+
+    if subject_prefix is not None:
+        prefix = _encode_header_value(subject_prefix)
+        header, replaced = _RE_SUBJECT.subn(
+            lambda match: match[0].rstrip(b' \t') + b' ' + prefix + (b'' if match[1] is not None else b' '),
+            header,
+            count=1
+        )
+        if not replaced:
+            header_fields.append((b'Subject', prefix))
+
+    return EMPTYBYTES.join((
+        header,
+        *(name + b': ' + value + ending for name, value in header_fields),
+        content[header_end:],
+    ))
+
+
 class AISpamFrowarding:
-    def __init__(self, filter_daemon: AIFilterDaemon, next_peer: str):
-        self.filter_daemon = filter_daemon
+    def __init__(self, classifier: AIFilterExecutor, next_peer: str):
+        self.classifier = classifier
         self.next_peer = next_peer
+        self.next_hop = NextHopPool(
+            next_peer=next_peer,
+            max_connections=NEXT_PEER_MAX_CONNECTIONS,
+            idle_timeout=NEXT_PEER_IDLE_TIMEOUT,
+            max_messages=NEXT_PEER_MAX_MESSAGES,
+            timeout=NEXT_PEER_TIMEOUT,
+        )
 
     async def handle_DATA(self, server: SMTP, session: Session, envelope: Envelope):
         recipients: list[str] = [
             str(rcpt) for rcpt in envelope.rcpt_tos  # type:ignore
         ]
 
-        log(LOG_INFO, f'Parsing mail for {", ".join(recipients)}')
+        if is_log_enabled(LOG_INFO):
+            log(LOG_INFO, 'Parsing mail for %s', ", ".join(recipients))
 
         # Get the original message
         _original_message = envelope.content
@@ -57,27 +148,26 @@ class AISpamFrowarding:
             else _original_message
         )
 
-        def recipient_applies(recipient: str) -> bool:
-            return reduce(
-                (
-                    lambda apply, re_tuple:
-                    re_tuple[1]
-                    if re.match(pattern=re_tuple[0], string=recipient, flags=re.IGNORECASE)
-                    else apply
-                ),
-                RE_RECIPIENTS_FILTER,
-                True
-            )
-
         # Determine for wich recipients we should perform spam detection
         skip_recipients: list[str] = []
         apply_recipients: list[str] = []
         for recipient in recipients:
-            if recipient_applies(recipient):
+            if _recipient_filter.applies(recipient):
                 apply_recipients.append(recipient)
             else:
                 skip_recipients.append(recipient)
 
+        # Refuse the whole mail before passing any of it on if too many mails
+        # are waiting for classification. The client will retry later.
+        if apply_recipients and not self.classifier.try_acquire():
+            log(
+                LOG_WARN,
+                'Classification queue full (%d mails). Deferring mail for %s',
+                self.classifier.in_flight, ", ".join(recipients)
+            )
+            metrics.MAILS.inc('deferred')
+            return f"{SMTP_ERROR_CODE_451} 4.3.2 Too many mails to check, try again later"
+
         skip_refused: dict[str, tuple[int, bytes]] = {}
         apply_refused: dict[str, tuple[int, bytes]] = {}
 
@@ -90,61 +180,29 @@ class AISpamFrowarding:
                 content=original_message
             )
 
-        # Pass mail unchanged for skip_recipients
-        if skip_recipients:
-            log(
-                LOG_DEBUG,
-                f'Skip spam detection for recipients {", ".join(skip_recipients)}'
-            )
-            skip_refused = await pass_message_unchanged(skip_recipients)
-
-        # Run spam detection for apply_recipients
-        if apply_recipients:
-
-            # Create a new message to modify
-            parser = BytesParser(policy=policy.default)
-            parsed_message = convert_message(
-                parser.parsebytes(original_message)
-            )
-            # modified_message = EmailMessage(policy=policy.default)
-            # modified_message.set_content(original_message)
-
-            try:
-                prediction, label = self.filter_daemon.predict_mail(
-                    parsed_message
-                )
-
-                if prediction and SUBJECT_PREFIX is not None:
-                    # Modify the subject
-                    old_subject = str(parsed_message.get('Subject') or '')
-                    parsed_message.replace_header(
-                        'Subject',
-                        f"{SUBJECT_PREFIX} {old_subject}"
-                    )
-
-                # Add custom headers
-                parsed_message.add_header(
-                    f'{MAIL_HEADER_FIELD_PREFIX.decode()}-Result', label
-                )
-
-                log(
-                    LOG_DEBUG,
-                    f'Spam detection result {label} for recipients {", ".join(apply_recipients)}'
-                )
-
-                # Forward the modified message
-                apply_refused = await self._handle_DATA(
+        start = time.perf_counter()
+        try:
+            # Pass mail unchanged for skip_recipients
+            if skip_recipients:
+                if is_log_enabled(LOG_DEBUG):
+                    log(LOG_DEBUG, 'Skip spam detection for recipients %s', ", ".join(skip_recipients))
+                skip_refused = await pass_message_unchanged(skip_recipients)
+
+            # Run spam detection for apply_recipients
+            if apply_recipients:
+                apply_refused = await self._check_and_forward(
                     server=server,
                     session=session,
                     mail_from=str(envelope.mail_from),
                     rcpt_tos=apply_recipients,
-                    content=parsed_message.as_bytes()
+                    original_message=original_message,
                 )
-
-            except OperationalError as error:
-                log(LOG_ERROR, str(error))
-                log(LOG_INFO, "Passing mail untested.")
-                apply_refused = await pass_message_unchanged(apply_recipients)
+        finally:
+            if apply_recipients:
+                self.classifier.release()
+            else:
+                metrics.MAILS.inc('skipped')
+            metrics.STAGE_SECONDS.observe(time.perf_counter() - start, 'total')
 
         refused = {**skip_refused, **apply_refused}
 
@@ -162,8 +220,91 @@ class AISpamFrowarding:
 
         return "250 OK"
 
+    async def _check_and_forward(
+        self, server: SMTP, session: Session, mail_from: str, rcpt_tos: list[str], original_message: bytes
+    ):
+        """
+        Classify the mail and forward it with the result added
+
+        Returns:
+            _type_: list of errors and failed recipients
+        """
+        try:
+            result = await self.classifier.predict_mail(original_message)
+        except OperationalError as error:
+            log(LOG_ERROR, error)
+            log(LOG_INFO, "Passing mail untested.")
+            metrics.MAILS.inc('untested')
+            return await self._handle_DATA(
+                server=server,
+                session=session,
+                mail_from=mail_from,
+                rcpt_tos=rcpt_tos,
+                content=original_message
+            )
+
+        prediction, label, score = result.is_spam, result.label, result.score
+        if is_log_enabled(LOG_DEBUG):
+            log(
+                LOG_DEBUG,
+                'Spam detection result %s (score %.3f) for recipients %s',
+                label, score, ", ".join(rcpt_tos)
+            )
+        score_value = f"{score:.4f}"
+        metrics.MAILS.inc('spam' if prediction else 'ham')
+
+        subject_prefix = SUBJECT_PREFIX if prediction else None
+
+        if FORWARD_HEADER_SPLICE:
+            # Forward the original body and only rewrite the header block
+            return await self._handle_DATA(
+                server=server,
+                session=session,
+                mail_from=mail_from,
+                rcpt_tos=rcpt_tos,
+                content=original_message,
+                header_fields=[
+                    (MAIL_HEADER_FIELD_PREFIX + b'-Result', label.encode('ascii')),
+                    (MAIL_HEADER_FIELD_PREFIX + b'-Score', score_value.encode('ascii')),
+                ],
+                subject_prefix=subject_prefix,
+            )
+
+        # Create a new message to modify
+        parser = BytesParser(policy=policy.default)
+        parsed_message = convert_message(
+            parser.parsebytes(original_message)
+        )
+
+        if subject_prefix is not None:
+            # Modify the subject
+            old_subject = str(parsed_message.get('Subject') or '')
+            parsed_message.replace_header(
+                'Subject',
+                f"{subject_prefix} {old_subject}"
+            )
+
+        # Add custom headers
+        parsed_message.add_header(
+            f'{MAIL_HEADER_FIELD_PREFIX.decode()}-Result', label
+        )
+        parsed_message.add_header(
+            f'{MAIL_HEADER_FIELD_PREFIX.decode()}-Score', score_value
+        )
+
+        # Forward the modified message
+        return await self._handle_DATA(
+            server=server,
+            session=session,
+            mail_from=mail_from,
+            rcpt_tos=rcpt_tos,
+            content=parsed_message.as_bytes()
+        )
+
     async def _handle_DATA(
-        self, server: SMTP, session: Session, mail_from: str, rcpt_tos: list[str], content: bytes  # pylint: disable=unused-argument
+        self, server: SMTP, session: Session, mail_from: str, rcpt_tos: list[str], content: bytes,  # pylint: disable=unused-argument
+        header_fields: list[tuple[bytes, bytes]] | None = None,
+        subject_prefix: str | None = None,
     ):
         """
         Adapted from aiosmtpd.handler.Proxy to return correct result
@@ -171,87 +312,35 @@ class AISpamFrowarding:
         Returns:
             _type_: list of errors and failed recipients
         """
-        lines = content.splitlines(keepends=True)
-        # Look for the last header
-        _i = 0
-        ending = CRLF
-        for _i, line in enumerate(lines):  # pragma: nobranch
-            if NLCRE.match(line):
-                ending = line
-                break
+        header_fields = list(header_fields or [])
         if session.peer is not None:
             peer = (
                 session.peer.encode("ascii") or b'unix-socket'
                 if isinstance(session.peer, str)
                 else session.peer[0].encode("ascii")
             )
-            lines.insert(_i, MAIL_HEADER_FIELD_PREFIX +
-                         b"-Peer: " + peer + ending)
+            header_fields.append((MAIL_HEADER_FIELD_PREFIX + b"-Peer", peer))
 
-        data = EMPTYBYTES.join(lines)
-        refused = self._deliver(mail_from, rcpt_tos, data)
+        data = splice_header_fields(
+            content=content,
+            header_fields=header_fields,
+            subject_prefix=subject_prefix,
+        )
+        refused = await self._deliver(mail_from, rcpt_tos, data)
         # TBD: what to do with refused addresses?
         return refused
 
-    def _deliver(
-        self, mail_from: str, rcpt_tos: list[str], data: AnyStr
+    async def _deliver(
+        self, mail_from: str, rcpt_tos: list[str], data: bytes
     ):
         """
-        Adapted from aiosmtpd.handler.Proxy to support unix sockets as receiving mail server
+        Deliver the mail over a pooled connection to the next hop
 
         Returns:
-            _type_: _description_
+            _type_: list of errors and failed recipients
         """
-        refused: dict[str, tuple[int, bytes]] = {}
+        start = time.perf_counter()
         try:
-            smtp: smtplib.SMTP
-            if self.next_peer.find('/') >= 0:
-                log(
-                    LOG_DEBUG,
-                    f"Trying to send mail to next hop via unix:{self.next_peer}"
-                )
-                smtp = UnixSocketSMTP(os.path.abspath(self.next_peer))
-            else:
-                smtp = smtplib.SMTP()
-
-                socket_data = self.next_peer.split(sep=':', maxsplit=1)
-                hostname: str = socket_data[0]
-                port: int = (
-                    int(socket_data[1])
-                    if len(socket_data) > 1
-                    else NEXT_PEER_PORT_DEFAULT
-                )
-                log(
-                    LOG_DEBUG,
-                    f"Trying to send mail to next hop via smtp:{hostname}:{port}"
-                )
-                smtp.connect(hostname, port)
-
-            try:
-                refused = smtp.sendmail(mail_from, rcpt_tos, data)  # pytype: disable=wrong-arg-types  # noqa: E501
-                log(
-                    LOG_DEBUG,
-                    f"Refused error: {refused}"
-                )
-            finally:
-                smtp.quit()
-        except smtplib.SMTPRecipientsRefused as e:  # pylint:disable=invalid-name
-            refused = e.recipients
-            log(
-                LOG_ERROR,
-                f"SMTPRecipientsRefused: {e}"
-            )
-        except (OSError, smtplib.SMTPException) as e:  # pylint:disable=invalid-name
-            log(
-                LOG_ERROR,
-                f"SMTPException: {e}"
-            )
-            # All recipients were refused.  If the exception had an associated
-            # error code, use it.  Otherwise, fake it with a non-triggering
-            # exception code.
-            errcode = getattr(e, "smtp_code", -1)
-            errmsg = getattr(e, "smtp_error", b"ignore")
-            for r in rcpt_tos:
-                refused[str(r)] = (errcode, errmsg)
-
-        return refused
+            return await self.next_hop.deliver(mail_from, rcpt_tos, data)
+        finally:
+            metrics.STAGE_SECONDS.observe(time.perf_counter() - start, 'deliver')
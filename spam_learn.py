@@ -1,44 +1,45 @@
 
+import argparse
 import os
-import re
-import sys
 import time
-from random import shuffle
-from typing import Callable, NamedTuple
+from concurrent.futures import Executor, ProcessPoolExecutor
+from itertools import islice
+from random import randrange, shuffle
+from typing import Callable, Iterable, Iterator, NamedTuple, TypeVar
 
-from config import (DEFAULT_SPAM_LEARN_DIRS, LAST_LEARN_SEMAPHORE,
+from config import (DATA_DIR, DEFAULT_SPAM_LEARN_DIRS, LAST_LEARN_SEMAPHORE,
                     RE_IGNORE_PATH, RE_SPAM_PATH)
 from config_model import SpamDetectorModel
-from constants import TRAIN_CHUNK_SIZE
+from constants import (MAIL_CACHE_FILE_NAME, SHUFFLE_BUFFER_SIZE,
+                       TRAIN_CHUNK_SIZE)
+from mail_cache import MailContentCache
 from mail_logging import LOG_DEBUG, LOG_INFO
 from mail_logging.logging import log
 from mail_types import MailContent
 from models.base import SpamDetectorModelBase
-from tools import fix_re_tuples, read_mail_from_file, valid_file_name
+from rules import compile_patterns
+from tools import (fix_re_tuples, get_extraction_version, read_mail_from_file,
+                   valid_file_name)
 
-label_files: list[tuple[str, str]] = []
+T = TypeVar('T')
 
 
 class OptionsType(NamedTuple):
     not_before: float | None = None
+    jobs: int = 1
+    use_cache: bool = True
 
 
 def __scope1() -> tuple[Callable[[str], str], Callable[[str], bool]]:
-    _re_spam_path = fix_re_tuples(RE_SPAM_PATH)
+    _re_spam_path = compile_patterns(fix_re_tuples(RE_SPAM_PATH))
 
     def __get_label(path: str) -> str:
-        for regexp, flags in _re_spam_path:
-            if re.search(regexp, path, flags=flags):
-                return "spam"
-        return "ham"
+        return "spam" if _re_spam_path.search(path) else "ham"
 
-    _re_ignore_path = fix_re_tuples(RE_IGNORE_PATH)
+    _re_ignore_path = compile_patterns(fix_re_tuples(RE_IGNORE_PATH))
 
     def __ignore_path(path: str) -> bool:
-        for regexp, flags in _re_ignore_path:
-            if re.search(regexp, path, flags=flags):
-                return True
-        return False
+        return bool(_re_ignore_path.search(path))
 
     return __get_label, __ignore_path
 
@@ -46,63 +47,205 @@ def __scope1() -> tuple[Callable[[str], str], Callable[[str], bool]]:
 _get_label, _ignore_path = __scope1()
 
 
-def add_files(root_path: str, rel_path: str, options: OptionsType):
-    ignore_file = _ignore_path(rel_path)
-
-    label: str = _get_label(rel_path)
-    print(rel_path, label, f'ignore: {ignore_file}')
-
-    for file in os.listdir(os.path.join(root_path, rel_path)):
-        rel_file_path = os.path.normpath(os.path.join(rel_path, file))
-        full_file_path = os.path.join(root_path, rel_file_path)
-        if os.path.isdir(full_file_path):
-            if options.not_before is not None and os.stat(full_file_path).st_mtime < options.not_before:
-                continue
-
-            add_files(
-                root_path=root_path,
-                rel_path=rel_file_path,
-                options=options
-            )
+class MailFile(NamedTuple):
+    label: str
+    path: str
+    stat: os.stat_result
+
+
+def scan_files(root_path: str, options: OptionsType) -> Iterator[MailFile]:
+    """
+    Find the mail files below a directory
+
+    Files not changed since `options.not_before` are skipped.
+
+    Args:
+        root_path (str): directory to scan
+        options (OptionsType): options
+
+    Yields:
+        Iterator[MailFile]: label, path and stat of each mail file
+    """
+    rel_pathes: list[str] = ['']
+    while rel_pathes:
+        rel_path = rel_pathes.pop()
+        ignore_file = _ignore_path(rel_path)
+
+        label: str = _get_label(rel_path)
+        log(LOG_DEBUG, f"Scanning '{rel_path}' as {label} (ignore: {ignore_file})")
+
+        with os.scandir(os.path.join(root_path, rel_path)) as entries:
+            for entry in entries:
+                rel_file_path = os.path.normpath(
+                    os.path.join(rel_path, entry.name)
+                )
+                if entry.is_dir():
+                    # the mtime of a directory does not change with the
+                    # contents of its subdirectories, so all are scanned
+                    rel_pathes.append(rel_file_path)
+                    continue
+
+                if ignore_file:
+                    continue
+
+                full_file_path = os.path.join(root_path, rel_file_path)
+                if not valid_file_name(entry.name):
+                    log(LOG_DEBUG, f"Skipping {label} file {full_file_path}")
+                    continue
+
+                stat = entry.stat()
+                # moving a mail to another folder changes its ctime only
+                if options.not_before is not None and max(stat.st_mtime, stat.st_ctime) < options.not_before:
+                    continue
+
+                yield MailFile(label, full_file_path, stat)
+
+
+def shuffled(items: Iterable[T], buffer_size: int) -> Iterator[T]:
+    """
+    Shuffle a stream of items keeping at most `buffer_size` of them in memory
+    """
+    buffer: list[T] = []
+    for item in items:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
             continue
 
-        if ignore_file:
-            continue
-
-        if valid_file_name(rel_file_path):
-            label_files.append((label, full_file_path))
+        index = randrange(buffer_size)
+        yield buffer[index]
+        buffer[index] = item
+
+    shuffle(buffer)
+    yield from buffer
+
+
+def train(
+    path: str, spam_model: SpamDetectorModelBase, options: OptionsType,
+    cache: MailContentCache | None = None, vocabulary_only: bool = False
+):
+    """
+    Learn the mails below a directory
+
+    Args:
+        path (str): directory to learn
+        spam_model (SpamDetectorModelBase): model to train
+        options (OptionsType): options
+        cache (MailContentCache | None, optional): cache of parsed mails. Defaults to None.
+        vocabulary_only (bool, optional): learn only the vocabulary of the mails. Defaults to False.
+    """
+    what = 'the vocabulary of mails' if vocabulary_only else 'mails'
+    log(LOG_INFO, f"Training {what} from '{path}'...")
+
+    mail_count = 0
+    files = shuffled(
+        scan_files(root_path=path, options=options),
+        SHUFFLE_BUFFER_SIZE
+    )
+    for round_no, (mail_contents, labels) in enumerate(read_chunks(files, options, cache)):
+        log(LOG_DEBUG, f"Learning {what} (round {round_no + 1})")
+        if vocabulary_only:
+            spam_model.learn_vocabulary(contents=mail_contents)
         else:
-            log(LOG_DEBUG, f"Skipping {label} file {full_file_path}")
-
-
-def train(path: str, spam_model: SpamDetectorModelBase, options: OptionsType):
-    log(LOG_INFO, f"Loading mails from '{path}'")
-    add_files(root_path=path, rel_path='', options=options)
-
-    log(LOG_INFO, f"Training {len(label_files)} mails...")
-
-    shuffle(label_files)
-
-    def _train(round_no: int):
-        start = round_no * TRAIN_CHUNK_SIZE
-        end = start + TRAIN_CHUNK_SIZE
-
-        mail_contents: list[MailContent] = []
-        labels: list[str] = []
-
-        log(LOG_DEBUG, f"Reading files (round {round_no + 1})")
-        for label, file_name in label_files[start:end]:
-            mail_content = read_mail_from_file(file_name)
-            if mail_content is not None:
-                mail_contents.append(mail_content)
-                labels.append(label)
-
-        spam_model.learn_mails(contents=mail_contents, labels=labels)
+            spam_model.learn_mails(contents=mail_contents, labels=labels)
+        mail_count += len(mail_contents)
+
+    if vocabulary_only:
+        log(LOG_INFO, f"Learned the vocabulary of {mail_count} mails from '{path}'")
+    else:
+        log(LOG_INFO, f"Trained {mail_count} mails from '{path}'")
+
+
+class _PendingChunk(NamedTuple):
+    files: list[MailFile]
+    cached: list[MailContent | None]
+    # contents of the files not found in the cache
+    parsed: Iterator[MailContent | None]
+
+
+def _start_chunk(
+    files: list[MailFile], options: OptionsType, executor: Executor | None, cache: MailContentCache | None
+) -> _PendingChunk:
+    cached: list[MailContent | None] = [
+        cache.get(file_name, stat) if cache is not None else None
+        for _, file_name, stat in files
+    ]
+    missing = [
+        file_name
+        for (_, file_name, _), content in zip(files, cached)
+        if content is None
+    ]
+
+    parsed: Iterator[MailContent | None] = (
+        executor.map(
+            read_mail_from_file,
+            missing,
+            chunksize=max(1, len(missing) // (options.jobs * 4))
+        )
+        if executor is not None
+        else map(read_mail_from_file, missing)
+    )
+    return _PendingChunk(files, cached, parsed)
+
+
+def _finish_chunk(
+    pending: _PendingChunk, cache: MailContentCache | None
+) -> tuple[list[MailContent], list[str]]:
+    mail_contents: list[MailContent] = []
+    labels: list[str] = []
+    for (label, file_name, stat), mail_content in zip(pending.files, pending.cached):
+        if mail_content is None:
+            mail_content = next(pending.parsed)
+            if mail_content is not None and cache is not None:
+                cache.put(file_name, stat, mail_content)
+
+        if mail_content is not None:
+            mail_contents.append(mail_content)
+            labels.append(label)
+
+    if cache is not None:
+        cache.commit()
+    return (mail_contents, labels)
+
+
+def read_chunks(
+    files: Iterable[MailFile], options: OptionsType, cache: MailContentCache | None = None
+) -> Iterator[tuple[list[MailContent], list[str]]]:
+    """
+    Read and parse mails in chunks of TRAIN_CHUNK_SIZE keeping their order
+
+    Mails found in the cache are not parsed again. With more than one job the
+    other mails are parsed in worker processes, and the next chunk is parsed
+    while the current one is being learned.
+
+    Args:
+        files (Iterable[MailFile]): mail files
+        options (OptionsType): options
+        cache (MailContentCache | None, optional): cache of parsed mails. Defaults to None.
+
+    Yields:
+        Iterator[tuple[list[MailContent], list[str]]]: mail contents and labels of each chunk
+    """
+    files = iter(files)
+    chunks = iter(lambda: list(islice(files, TRAIN_CHUNK_SIZE)), [])
+
+    executor = (
+        ProcessPoolExecutor(max_workers=options.jobs)
+        if options.jobs > 1
+        else None
+    )
+    try:
+        pending: _PendingChunk | None = None
+        for chunk in chunks:
+            started = _start_chunk(chunk, options, executor, cache)
+            if pending is not None:
+                yield _finish_chunk(pending, cache)
+            pending = started
 
-    round_no = 0
-    while round_no * TRAIN_CHUNK_SIZE < len(label_files):
-        _train(round_no)
-        round_no += 1
+        if pending is not None:
+            yield _finish_chunk(pending, cache)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
 
 
 def train_all(*pathes: str, options: OptionsType | None):
@@ -111,15 +254,67 @@ def train_all(*pathes: str, options: OptionsType | None):
     spam_detector_model: SpamDetectorModelBase = SpamDetectorModel(
         for_training=True
     )
-    for path in pathes:
-        train(path=path, spam_model=spam_detector_model, options=options)
-    spam_detector_model.save_model()
+    cache = (
+        MailContentCache(
+            file_name=os.path.join(
+                os.path.abspath(DATA_DIR), MAIL_CACHE_FILE_NAME
+            ),
+            version=get_extraction_version()
+        )
+        if options.use_cache
+        else None
+    )
+    try:
+        if spam_detector_model.incremental and spam_detector_model.is_new():
+            log(LOG_INFO, f"Training all mails, there is no '{type(spam_detector_model).__name__}' model yet")
+            options = options._replace(not_before=None)
+        if not spam_detector_model.incremental:
+            log(LOG_INFO, f"Training all mails, '{type(spam_detector_model).__name__}' cannot learn new mails only")
+            options = options._replace(not_before=None)
+            for path in pathes:
+                train(
+                    path=path,
+                    spam_model=spam_detector_model,
+                    options=options,
+                    cache=cache,
+                    vocabulary_only=True
+                )
+        for path in pathes:
+            train(
+                path=path,
+                spam_model=spam_detector_model,
+                options=options,
+                cache=cache
+            )
+        spam_detector_model.save_model()
+        if cache is not None:
+            cache.evict()
+    finally:
+        if cache is not None:
+            cache.close()
 
 
 if __name__ == '__main__':
-    dirs: list[str] = DEFAULT_SPAM_LEARN_DIRS
-    if len(sys.argv) > 1:
-        dirs = [dir for dir in sys.argv[1:] if os.path.isdir(dir)]
+    parser = argparse.ArgumentParser(
+        description="Train the spam detector on mail directories"
+    )
+    parser.add_argument(
+        'dirs', nargs='*', default=DEFAULT_SPAM_LEARN_DIRS,
+        help='Mail directories to learn from.',
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        dest='jobs', type=int, default=1,
+        help='Number of processes reading and parsing mails.',
+    )
+    parser.add_argument(
+        '--no-cache',
+        dest='use_cache', action='store_false',
+        help='Parse all mails instead of using contents cached by earlier runs.',
+    )
+    args = parser.parse_args()
+
+    dirs: list[str] = [dir for dir in args.dirs if os.path.isdir(dir)]
 
     start_time = time.time()
 
@@ -129,7 +324,9 @@ if __name__ == '__main__':
         not_before = stats.st_mtime
 
     train_all(*dirs, options=OptionsType(
-        not_before=not_before
+        not_before=not_before,
+        jobs=args.jobs,
+        use_cache=args.use_cache,
     ))
 
     try:
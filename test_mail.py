@@ -1,21 +1,31 @@
 from sys import argv
 
+import config
 from config_model import SpamDetectorModel
+from constants import SPAM_THRESHOLD_DEFAULT
+from mail_types import MailContent
 from tools import read_mail_from_file
 
+# settings missing in configurations written before they were added
+SPAM_THRESHOLD: float = getattr(config, 'SPAM_THRESHOLD', SPAM_THRESHOLD_DEFAULT)
+
 
 def predict_mail(*_file_names: str):
 
     spam_detector = SpamDetectorModel(for_training=False)
-    predictions: list[bool] = []
 
+    file_names: list[str] = []
+    contents: list[MailContent] = []
     for file_name in _file_names:
         content = read_mail_from_file(file_name)
         if content is not None:
-            predictions.append(spam_detector.predict_mail(content=content))
+            file_names.append(file_name)
+            contents.append(content)
+
+    scores = spam_detector.predict_proba_mails(contents=contents)
 
-    for i, file_name in enumerate(_file_names):
-        print(predictions[i], f"predicted for {file_name}")
+    for file_name, score in zip(file_names, scores):
+        print(score >= SPAM_THRESHOLD, f"predicted for {file_name} (score {score:.3f})")
 
 
 if __name__ == '__main__':
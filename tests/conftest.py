@@ -0,0 +1,18 @@
+"""
+Make the modules of the repository importable. Without a config.py the
+example configuration is used.
+"""
+
+import importlib.util
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+if importlib.util.find_spec('config') is None:
+    _spec = importlib.util.spec_from_file_location('config', os.path.join(ROOT, 'config.example.py'))
+    assert _spec is not None and _spec.loader is not None
+    _config = importlib.util.module_from_spec(_spec)
+    sys.modules['config'] = _config
+    _spec.loader.exec_module(_config)
@@ -0,0 +1,39 @@
+import asyncio
+import os
+import signal
+from concurrent.futures import ProcessPoolExecutor
+from sqlite3 import OperationalError
+
+import pytest
+
+from ai_filter_daemon import AIFilterDaemon
+from ai_filter_executor import AIFilterExecutor
+from constants import CLASSIFIER_EXECUTOR_PROCESS
+from mail_logging import LOG_FILE_CONSOLE, LOG_INFO
+
+
+def test_killed_worker_replaces_pool(monkeypatch: pytest.MonkeyPatch):
+    # workers without a model, only the pool is tested
+    monkeypatch.setattr(
+        AIFilterExecutor, '_create_executor', lambda self: ProcessPoolExecutor(max_workers=self.workers)
+    )
+    classifier = AIFilterExecutor(
+        filter_daemon=AIFilterDaemon(),
+        executor_type=CLASSIFIER_EXECUTOR_PROCESS,
+        workers=1,
+        max_in_flight=1,
+        log_file=LOG_FILE_CONSOLE,
+        log_level=LOG_INFO,
+    )
+    try:
+        broken_executor = classifier._executor  # pylint: disable=protected-access
+        os.kill(broken_executor.submit(os.getpid).result(), signal.SIGKILL)
+
+        with pytest.raises(OperationalError):
+            asyncio.run(classifier.predict_mail(b'Subject: test\r\n\r\ntest\r\n'))
+
+        executor = classifier._executor  # pylint: disable=protected-access
+        assert executor is not broken_executor
+        assert executor.submit(os.getpid).result() != os.getpid()
+    finally:
+        classifier.shutdown()
@@ -0,0 +1,65 @@
+import numpy as np
+from sklearn.naive_bayes import MultinomialNB  # type: ignore
+
+from constants import CALIBRATION_MIN_MAILS
+from models.calibration import Calibration
+from models.hashing_multinominal_nb import SpamDetectorModelHashingMultinominal
+
+
+def test_uncalibrated_probability_of_log_odds():
+    probabilities = Calibration().predict_proba(np.array([-2.0, 0.0, 2.0]))
+    assert np.allclose(probabilities, 1 / (1 + np.exp([2.0, 0.0, -2.0])))
+
+
+def test_separable_mails_do_not_saturate():
+    log_odds = np.concatenate((np.linspace(-900, -100, 50), np.linspace(100, 900, 50)))
+    is_spam = log_odds > 0
+    calibration = Calibration.fit(log_odds, is_spam)
+
+    probabilities = calibration.predict_proba(log_odds)
+    assert calibration.mails == 100
+    assert np.all((probabilities >= 0.5) == is_spam)
+    assert 1e-4 < probabilities.min() and probabilities.max() < 1 - 1e-4
+
+
+def test_save_and_load(tmp_path):
+    file_name = str(tmp_path / 'calibration.json')
+    Calibration(slope=0.25, intercept=-1.5, mails=10).save(file_name)
+    calibration = Calibration.load(file_name)
+    assert (calibration.slope, calibration.intercept, calibration.mails) == (0.25, -1.5, 10)
+    assert Calibration.load(str(tmp_path / 'missing.json')).slope == 1.0
+
+
+def _trained_model() -> SpamDetectorModelHashingMultinominal:
+    model = SpamDetectorModelHashingMultinominal(for_training=True)
+    # not loaded from DATA_DIR
+    model.model = MultinomialNB()
+    model.vectorizer = model._create_vectorizer()  # pylint: disable=protected-access
+    model.initialized = True
+    model.calibration = Calibration(slope=0.5, intercept=0.25, mails=100)
+    model.learn_mails(
+        [('a@example.com', 'meeting', 'agenda'), ('b@example.com', 'prize', 'win money')] * 10,
+        ['ham', 'spam'] * 10
+    )
+    return model
+
+
+def test_few_held_out_mails_keep_calibration():
+    model = _trained_model()
+    model.held_out_contents = [('a@example.com', 'meeting', 'agenda'), ('b@example.com', 'prize', 'win money')] * 2
+    model.held_out_labels = ['ham', 'spam'] * 2
+
+    model._calibrate()  # pylint: disable=protected-access
+    assert (model.calibration.slope, model.calibration.intercept) == (0.5, 0.25)
+    # the held out mails are learned anyway
+    assert not model.held_out_contents
+    assert model.model.class_count_.sum() == 18 + 4
+
+
+def test_held_out_mails_of_each_label_are_calibrated_on():
+    model = _trained_model()
+    model.held_out_contents = [('a@example.com', 'meeting', 'agenda'), ('b@example.com', 'prize', 'win money')] * CALIBRATION_MIN_MAILS
+    model.held_out_labels = ['ham', 'spam'] * CALIBRATION_MIN_MAILS
+
+    model._calibrate()  # pylint: disable=protected-access
+    assert model.calibration.mails == 2 * CALIBRATION_MIN_MAILS
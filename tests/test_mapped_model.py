@@ -0,0 +1,40 @@
+import numpy as np
+from scipy.sparse import csr_matrix  # type: ignore
+
+from models.mapped_model import MappedModel
+
+CLASSES = np.array(['ham', 'spam'])
+CLASS_LOG_PRIOR = np.log([0.4, 0.6])
+FEATURE_LOG_PROB = np.log([[0.5, 0.3, 0.2], [0.1, 0.1, 0.8]])
+FEATURES = csr_matrix(np.array([[1.0, 0.0, 2.0], [0.0, 3.0, 0.0]]))
+
+
+def test_feature_weights_are_mapped_contiguous(tmp_path):
+    directory = str(tmp_path / 'model.mapped')
+    MappedModel.save(directory, CLASSES, CLASS_LOG_PRIOR, FEATURE_LOG_PROB, vocabulary={'a': 0, 'b': 1, 'c': 2})
+    model = MappedModel.load(directory)
+
+    assert isinstance(model.feature_weights, np.memmap)
+    assert model.feature_weights.flags.c_contiguous
+    assert model.feature_weights.shape == (3, 2)
+    assert model.n_features == 3
+    assert np.allclose(
+        model.joint_log_likelihood(FEATURES),
+        FEATURES.toarray() @ FEATURE_LOG_PROB.T + CLASS_LOG_PRIOR
+    )
+
+
+def test_load_old_layout(tmp_path):
+    directory = tmp_path / 'model.mapped'
+    directory.mkdir()
+    np.save(directory / 'classes.npy', CLASSES)
+    np.save(directory / 'class_log_prior.npy', CLASS_LOG_PRIOR)
+    np.save(directory / 'feature_log_prob.npy', FEATURE_LOG_PROB)
+    assert MappedModel.exists(str(directory))
+
+    model = MappedModel.load(str(directory))
+    assert model.feature_weights.flags.c_contiguous
+    assert np.allclose(
+        model.joint_log_likelihood(FEATURES),
+        FEATURES.toarray() @ FEATURE_LOG_PROB.T + CLASS_LOG_PRIOR
+    )
@@ -0,0 +1,28 @@
+import asyncio
+import socket
+
+import pytest
+
+from metrics import start_metrics_server
+
+
+def test_unix_socket_replaces_old_socket(tmp_path):
+    path = str(tmp_path / 'metrics.sock')
+    with socket.socket(socket.AF_UNIX) as old_socket:
+        old_socket.bind(path)
+
+    async def start() -> None:
+        server = await start_metrics_server(path)
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(start())
+
+
+def test_unix_socket_keeps_file(tmp_path):
+    path = tmp_path / 'metrics.sock'
+    path.write_text('data')
+
+    with pytest.raises(OSError):
+        asyncio.run(start_metrics_server(str(path)))
+    assert path.read_text() == 'data'
@@ -0,0 +1,49 @@
+import asyncio
+
+from next_hop import NextHopPool
+
+
+async def _refusing_server(received: list[bytes]) -> asyncio.Server:
+    """
+    Next hop refusing all recipients but accepting DATA like some servers do
+    """
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        writer.write(b'220 localhost\r\n')
+        while line := await reader.readline():
+            received.append(line)
+            command = line[:4].upper()
+            if command == b'EHLO':
+                writer.write(b'250-localhost\r\n250 PIPELINING\r\n')
+            elif command == b'RCPT':
+                writer.write(b'550 unknown user\r\n')
+            elif command == b'DATA':
+                writer.write(b'354 go ahead\r\n')
+            else:
+                writer.write(b'250 OK\r\n')
+        writer.close()
+
+    return await asyncio.start_server(handle, 'localhost', 0)
+
+
+def test_refused_recipients_drop_connection_in_data():
+    received: list[bytes] = []
+
+    async def deliver() -> dict[str, tuple[int, bytes]]:
+        server = await _refusing_server(received)
+        port = server.sockets[0].getsockname()[1]
+        pool = NextHopPool(f'localhost:{port}', max_connections=1, idle_timeout=60, max_messages=10, timeout=5)
+        try:
+            refused = await pool.deliver('a@example.com', ['b@example.com'], b'Subject: test\r\n\r\ntest\r\n')
+            await asyncio.sleep(0.1)
+            # the connection is not reused
+            assert not pool._idle  # pylint: disable=protected-access
+            return refused
+        finally:
+            await pool.close()
+            server.close()
+            await server.wait_closed()
+
+    refused = asyncio.run(deliver())
+    assert refused == {'b@example.com': (550, b'unknown user')}
+    # the mail is aborted, not ended with an empty one
+    assert b'.\r\n' not in received
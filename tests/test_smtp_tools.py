@@ -0,0 +1,66 @@
+import pytest
+
+from smtp_tools import splice_header_fields
+
+FIELDS = [(b'X-Spam', b'yes')]
+
+
+@pytest.mark.parametrize('content, expected', [
+    (
+        b'From: a\r\nSubject: hi\r\n\r\nbody\r\n',
+        b'From: a\r\nSubject: [SPAM] hi\r\nX-Spam: yes\r\n\r\nbody\r\n',
+    ),
+    (
+        b'From: a\r\nSubject: hi\r\n  there\r\n\r\nbody',
+        b'From: a\r\nSubject: [SPAM] hi\r\n  there\r\nX-Spam: yes\r\n\r\nbody',
+    ),
+    (
+        b'From: a\nSubject: hi\n\nbody\n\nmore\n',
+        b'From: a\nSubject: [SPAM] hi\nX-Spam: yes\n\nbody\n\nmore\n',
+    ),
+    (
+        b'From: a\nSubject: hi',
+        b'From: a\nSubject: [SPAM] hi\nX-Spam: yes\n',
+    ),
+    (
+        b'From: a\r\n',
+        b'From: a\r\nX-Spam: yes\r\nSubject: [SPAM]\r\n',
+    ),
+    (
+        b'From: a',
+        b'From: a\r\nX-Spam: yes\r\nSubject: [SPAM]\r\n',
+    ),
+    (
+        b'\r\nbody\r\n',
+        b'X-Spam: yes\r\nSubject: [SPAM]\r\n\r\nbody\r\n',
+    ),
+    (
+        b'',
+        b'X-Spam: yes\r\nSubject: [SPAM]\r\n',
+    ),
+    (
+        b'\r\nbody\r\n\r\nmore',
+        b'X-Spam: yes\r\nSubject: [SPAM]\r\n\r\nbody\r\n\r\nmore',
+    ),
+    (
+        b'Subject:\r\nFrom: a\r\n\r\nbody',
+        b'Subject: [SPAM]\r\nFrom: a\r\nX-Spam: yes\r\n\r\nbody',
+    ),
+    (
+        b'From: a\nSubject: \t\n\nbody',
+        b'From: a\nSubject: [SPAM]\nX-Spam: yes\n\nbody',
+    ),
+    (
+        b'Subject:\r\n hi\r\n\r\nbody',
+        b'Subject: [SPAM] \r\n hi\r\nX-Spam: yes\r\n\r\nbody',
+    ),
+])
+def test_splice_header_fields(content: bytes, expected: bytes):
+    assert splice_header_fields(content, FIELDS, '[SPAM]') == expected
+
+
+def test_splice_header_fields_keeps_subject_in_body():
+    content = b'From: a\r\n\r\nSubject: body\r\n'
+    assert splice_header_fields(content, [], '[SPAM]') == (
+        b'From: a\r\nSubject: [SPAM]\r\n\r\nSubject: body\r\n'
+    )
@@ -0,0 +1,15 @@
+import os
+
+from spam_learn import OptionsType, scan_files
+
+
+def test_scan_finds_new_mail_in_old_directories(tmp_path):
+    new_mail = tmp_path / 'user' / 'Spam' / '1.'
+    new_mail.parent.mkdir(parents=True)
+    new_mail.write_bytes(b'Subject: new\r\n\r\nnew\r\n')
+    # only the mail changed since the last run
+    for path in (new_mail.parent, new_mail.parent.parent):
+        os.utime(path, (1_000, 1_000))
+
+    files = list(scan_files(str(tmp_path), OptionsType(not_before=new_mail.stat().st_mtime - 10)))
+    assert [(mail_file.label, mail_file.path) for mail_file in files] == [('spam', str(new_mail))]
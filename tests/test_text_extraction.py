@@ -0,0 +1,60 @@
+import time
+
+import pytest
+
+from text_extraction import html_to_text_fast
+
+# doubling the input may take at most this much longer, quadratic time gives 4
+MAX_TIME_RATIO = 3.0
+
+
+def _normalize(text: str) -> str:
+    return ' '.join(text.split())
+
+
+def test_strips_tags_and_keeps_targets():
+    text = html_to_text_fast(
+        '<html><head><title>t</title></head><body>Hello &amp; <a href="http://a.example/x">link</a>'
+        '<img src=\'i.png\'><!-- comment --><script>var s = "<b>";</script>'
+        '<STYLE type="text/css">p {}</style >end</body></html>'
+    )
+    assert _normalize(text) == 'Hello & http://a.example/x link i.png end'
+
+
+def test_keeps_text_with_less_than():
+    assert _normalize(html_to_text_fast('<p>a < b</p>')) == 'a < b'
+
+
+@pytest.mark.parametrize('html_text, expected', [
+    ('text <style>p {}', 'text'),
+    ('text <script>var a;', 'text'),
+    ('text <!-- comment', 'text'),
+    ('text <a href="http://a.example"', 'text http://a.example'),
+    ('text <b', 'text'),
+])
+def test_unclosed_constructs_extend_to_the_end(html_text: str, expected: str):
+    assert _normalize(html_to_text_fast(html_text)) == expected
+
+
+def _best_time(html_text: str, repeats: int = 5) -> float:
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        html_to_text_fast(html_text)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+@pytest.mark.parametrize('prefix, repeated, count', [
+    ('', '<a href=x ', 20_000),
+    ('<a ', 'href=x ', 28_000),
+    ('', '<style>', 28_000),
+    ('<script>', '</script ', 20_000),
+    ('', '<!--', 50_000),
+    ('', '<', 200_000),
+    ('', '<b ', 66_000),
+])
+def test_unclosed_constructs_in_linear_time(prefix: str, repeated: str, count: int):
+    half = _best_time(prefix + repeated * (count // 2))
+    full = _best_time(prefix + repeated * count)
+    assert full / half < MAX_TIME_RATIO
@@ -0,0 +1,31 @@
+import base64
+import quopri
+from email import policy
+from email.message import EmailMessage
+from email.parser import BytesParser
+
+from tools import get_limited_content
+
+
+def _message(charset: str, encoding: str, payload: bytes) -> EmailMessage:
+    message = BytesParser(policy=policy.default).parsebytes(
+        b'Content-Type: text/plain; charset=' + charset.encode() + b'\r\n'
+        b'Content-Transfer-Encoding: ' + encoding.encode() + b'\r\n\r\n' + payload
+    )
+    assert isinstance(message, EmailMessage)
+    return message
+
+
+def test_quoted_printable_utf16():
+    message = _message('utf-16', 'quoted-printable', quopri.encodestring('Hello wörld'.encode('utf-16')))
+    assert get_limited_content(message, 100) == 'Hello wörld'
+
+
+def test_base64_without_padding():
+    encoded = base64.b64encode(b'hello world').rstrip(b'=')
+    assert get_limited_content(_message('ascii', 'base64', encoded), 100) == 'hello world'
+
+
+def test_base64_cut_at_limit():
+    encoded = base64.encodebytes(b'0123456789' * 100)
+    assert get_limited_content(_message('ascii', 'base64', encoded), 10) == '0123456789'
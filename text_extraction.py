@@ -0,0 +1,67 @@
+"""
+Extractors converting html mail bodies to text for the vectorizer
+"""
+
+import html
+import re
+from typing import Callable
+
+from constants import HTML_EXTRACTOR_FAST, HTML_EXTRACTOR_HTML2TEXT
+
+HtmlExtractorType = Callable[[str], str]
+
+# One pass over the html, every alternative is matched in linear time: each
+# construct ends at its closing or at the end of the text, so unclosed tags,
+# comments or scripts never make the engine scan the rest again.
+_RE_HTML = re.compile(
+    r'''
+    <!--.*?(?:-->|\Z)
+    | <(script|style|head)\b[^>]*+(?:>|\Z) .*? (?:</\1\s*+>|\Z)
+    | <(?:a|img)\b([^>]*+)(?:>|\Z)
+    | <[!/?a-z][^>]*+(?:>|\Z)
+    ''',
+    re.IGNORECASE | re.DOTALL | re.VERBOSE
+)
+# keep link and image targets like html2text does
+_RE_URL_ATTRIBUTE = re.compile(
+    r'''\b(?:href|src)\s*+=\s*+["']?+([^"'\s>]*+)''',
+    re.IGNORECASE
+)
+
+
+def _replace_html(match: re.Match[str]) -> str:
+    if match[2] is not None and (url := _RE_URL_ATTRIBUTE.search(match[2])):
+        return f" {url[1]} "
+    return ' '
+
+
+def html_to_text_fast(html_text: str) -> str:
+    """
+    Strip tags and decode entities without formatting the text
+
+    Scripts, styles, the head and comments are dropped. Link and image
+    targets are kept. Unclosed constructs extend to the end of the text.
+    """
+    return html.unescape(_RE_HTML.sub(_replace_html, html_text))
+
+
+def html_to_text_html2text(html_text: str) -> str:
+    """
+    Convert html to markdown formatted text
+    """
+    from html2text import \
+        html2text  # pylint: disable=import-outside-toplevel
+    return html2text(html_text)
+
+
+HTML_EXTRACTORS: dict[str, HtmlExtractorType] = {
+    HTML_EXTRACTOR_FAST: html_to_text_fast,
+    HTML_EXTRACTOR_HTML2TEXT: html_to_text_html2text,
+}
+
+
+def get_html_extractor(name: str) -> HtmlExtractorType:
+    try:
+        return HTML_EXTRACTORS[name]
+    except KeyError as error:
+        raise ValueError(f"Unknown html extractor '{name}'") from error
@@ -1,19 +1,45 @@
 
+import base64
+import binascii
+import hashlib
 import os
+import quopri
 import re
 from email import policy
 from email.message import EmailMessage, Message
 from email.parser import BytesParser
 
 import chardet
-from html2text import html2text
 
+import config
+import rules
+import text_extraction
 from config import RE_SPAM_SUBJECT_PREFIX
-from constants import MAX_SIZE
+from constants import HTML_TEXT_EXTRACTOR_DEFAULT, MAX_HTML_SIZE, MAX_SIZE
 from mail_logging import LOG_ERROR
 from mail_logging.logging import log
 from mail_types import MailContent
 
+# settings missing in configurations written before they were added
+HTML_TEXT_EXTRACTOR: str = getattr(config, 'HTML_TEXT_EXTRACTOR', HTML_TEXT_EXTRACTOR_DEFAULT)
+
+html_to_text = text_extraction.get_html_extractor(HTML_TEXT_EXTRACTOR)
+
+
+def get_extraction_version() -> str:
+    """
+    Get a stamp changing whenever the code or settings used to extract mail
+    contents change
+    """
+    digest = hashlib.sha256()
+    for file_name in (__file__, text_extraction.__file__, rules.__file__):
+        with open(file_name, 'rb') as fh:
+            digest.update(fh.read())
+    digest.update(repr((
+        HTML_TEXT_EXTRACTOR, MAX_SIZE, MAX_HTML_SIZE, RE_SPAM_SUBJECT_PREFIX
+    )).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
 
 def fix_re_tuples(res: list[tuple[str, re.RegexFlag] | str]):
     return tuple(
@@ -24,6 +50,11 @@ def fix_re_tuples(res: list[tuple[str, re.RegexFlag] | str]):
     )
 
 
+_spam_subject_prefixes = rules.compile_patterns(
+    fix_re_tuples(RE_SPAM_SUBJECT_PREFIX)
+)
+
+
 def detect_encoding(file_path: str):
     with open(file_path, 'rb') as file:
         raw_data = file.read(MAX_SIZE + 10)
@@ -47,6 +78,55 @@ def convert_message(message: EmailMessage | Message) -> EmailMessage:
     return email_message
 
 
+def get_limited_content(message: EmailMessage, max_size: int) -> str:
+    """
+    Decode at most `max_size` characters of a non multipart message's payload
+
+    Only the beginning of the transfer encoded payload is decoded, so the
+    costs do not depend on the size of the mail.
+    """
+    payload = message.get_payload()
+    if not isinstance(payload, str):
+        return ''
+
+    encoding = str(message.get('Content-Transfer-Encoding') or '').strip().lower()
+    if encoding not in ('base64', 'quoted-printable'):
+        # get_payload already decoded 8 bit payloads using the charset
+        return payload[:max_size]
+
+    charset = message.get_content_charset('ascii')
+    try:
+        ''.encode(charset)
+    except LookupError:
+        charset = 'utf-8'
+
+    # a character takes up to 4 bytes in utf-8
+    max_bytes = max_size * 4
+    if encoding == 'base64':
+        # 4 characters encode 3 bytes, leave room for line breaks
+        max_chars = max_bytes * 3 // 2
+        encoded = ''.join(payload[:max_chars].split())
+        if len(payload) > max_chars:
+            # decode only whole groups of the cut payload
+            encoded = encoded[:len(encoded) // 4 * 4]
+        else:
+            # the padding of the last group may be missing, a single
+            # character does not encode a byte
+            encoded = encoded[:len(encoded) - (len(encoded) % 4 == 1)]
+            encoded += '=' * (-len(encoded) % 4)
+        try:
+            data = base64.b64decode(encoded)
+        except binascii.Error:
+            data = b''
+    else:
+        # quoted-printable is ascii, the charset applies to the decoded bytes
+        data = quopri.decodestring(
+            payload[:max_bytes * 3].encode('ascii', errors='replace')
+        )
+
+    return data.decode(charset, errors='replace')[:max_size]
+
+
 def read_mail_from_file(file_name: str) -> MailContent | None:
     if valid_file_name(file_name):
         parser = BytesParser(policy=policy.default)
@@ -71,10 +151,9 @@ def read_mail(message: EmailMessage) -> MailContent:
     if match := re.search(r'[\w\.-]+@[\w\.-]+(?:\.[\w]+)+', email_from):
         email_from = match[0]
 
-    email_subject = str(message['Subject'] or '')
-    for re_tuple in fix_re_tuples(RE_SPAM_SUBJECT_PREFIX):
-        email_subject = re.sub(
-            re_tuple[0], repl='', string=email_subject, flags=re_tuple[1])
+    email_subject = _spam_subject_prefixes.remove(
+        str(message['Subject'] or '')
+    )
 
     def _get_body(message: EmailMessage):
         try:
@@ -95,9 +174,15 @@ def read_mail(message: EmailMessage) -> MailContent:
                 log(LOG_ERROR, str(error))
                 log(LOG_ERROR, 'Could not get body in multi part message. Parsing mail as is...')
 
-            email_body = message.get_content()
-            email_body = None if email_body is None else str(
-                email_body)
+            # do not decode attachments or other binary parts
+            if message.get_content_maintype() != 'text':
+                return None
+
+            is_html = message.get_content_type() == 'text/html'
+            email_body = get_limited_content(
+                message,
+                MAX_HTML_SIZE if is_html else MAX_SIZE
+            )
         except Exception as error:  # pylint: disable=broad-exception-caught
             log(
                 LOG_ERROR,
@@ -108,8 +193,8 @@ def read_mail(message: EmailMessage) -> MailContent:
             log(LOG_ERROR, message.get_charsets())
             return None
 
-        if email_body is not None and message.get_content_type() == 'text/html':
-            return html2text(email_body)
+        if is_html:
+            return html_to_text(email_body)[:MAX_SIZE]
         return email_body
 
     email_body = _get_body(message) or ''